@@ -22,6 +22,8 @@ import utils
 from climate_toolbox import (
     load_bcsd,
     load_baseline,
+    has_bcsd_store,
+    prepare_aggregation,
     weighted_aggregate_grid_to_regions)
 
 FORMAT = '%(asctime)-15s %(message)s'
@@ -160,8 +162,7 @@ MODELS = list(map(lambda x: dict(model=x), [
     'NorESM1-M']))
 
 AGGREGATIONS = [
-    {'agglev': 'ISO', 'aggwt': 'areawt'},
-    {'agglev': 'hierid', 'aggwt': 'areawt'}]
+    {'agglev': ('hierid', 'ISO'), 'aggwt': 'areawt'}]
 
 
 JOB_SPEC = [JOBS, PERIODS, MODELS, AGGREGATIONS]
@@ -178,7 +179,13 @@ def run_job(
         model,
         agglev,
         aggwt,
-        weights=None):
+        weights=None,
+        skipna=False,
+        regions=None,
+        region_codes=False,
+        partial=False,
+        chunks=None,
+        prefetch=1):
 
     # Add to job metadata
     metadata.update(dict(
@@ -188,22 +195,57 @@ def run_job(
         pprint.pformat(metadata, indent=2)))
 
     read_file = BCSD_orig_files.format(**metadata)
-    write_file = WRITE_PATH.format(**metadata)
-    
+
+    # regional levels listed together are aggregated in one pass
+    if isinstance(agglev, (list, tuple)):
+        agglevs = list(agglev)
+    else:
+        agglevs = [agglev]
+
+    write_files = {
+        level: utils.output_path(
+            WRITE_PATH.format(**dict(metadata, agglev=level)),
+            regions=regions,
+            skipna=(skipna and not level.startswith('grid')),
+            partial=(partial and not level.startswith('grid')))
+        for level in agglevs}
+
     # do not duplicate
-    if os.path.isfile(write_file):
+    agglevs = [
+        level for level in agglevs if not os.path.isfile(write_files[level])]
+
+    if len(agglevs) == 0:
         return
 
-    # Get transformed data
-    annual = []
-    for y in years:
-        
+    gridded = any([level.startswith('grid') for level in agglevs])
+
+    weights, fill, window = prepare_aggregation(
+        agglevs, weights=weights, skipna=skipna, regions=regions)
+
+    def load_year(y):
         fp = read_file.format(year=y)
-        
+
         logging.debug('year {} - attempting to read file "{}"'.format(y, fp))
-        annual.append(
-            load_bcsd(fp, variable, broadcast_dims=('time',))
-                .pipe(transformation))
+
+        if not (fill and has_bcsd_store(fp, variable)):
+            fp = utils.staged(fp)
+
+        return load_bcsd(
+            fp,
+            variable,
+            broadcast_dims=('time',),
+            workers=utils.get_num_workers(),
+            weights=weights,
+            fill=fill,
+            chunks=chunks,
+            window=window,
+            variables=[variable],
+            standardize_lon=gridded)
+
+    # Get transformed data, reading the next years while this one computes
+    annual = []
+    for ds in utils.prefetch(load_year, years, depth=prefetch):
+        annual.append(ds.pipe(transformation))
 
     logging.debug('concatenating & reducing annual data')
     ds = xr.Dataset({
@@ -211,24 +253,27 @@ def run_job(
                         .mean(dim='year')})
     
     # Reshape to regions
-    if not agglev.startswith('grid'):
-        logger.debug('aggregating to "{}" using "{}"'.format(agglev, aggwt))
-        ds = weighted_aggregate_grid_to_regions(
-                ds, variable, aggwt, agglev, weights=weights)
-
-    # Update netCDF metadata
-    ds.attrs.update(**metadata)
+    if gridded:
+        outputs = {level: ds for level in agglevs}
 
-    # Write output
-    if not os.path.isdir(os.path.dirname(write_file)):
-        logger.debug('attempting to create_directory "{}"'
-            .format(os.path.dirname(write_file)))
+    else:
+        logger.debug('aggregating to "{}" using "{}"'.format(
+            ', '.join(agglevs), aggwt))
 
-        os.makedirs(os.path.dirname(write_file))
+        outputs = weighted_aggregate_grid_to_regions(
+                ds, variable, aggwt, agglevs, weights=weights, skipna=skipna,
+                regions=regions, partial=partial)
 
-    logger.debug('attempting to write to file "{}"'.format(write_file))
+    logger.debug('attempting to write to files "{}"'.format(
+        ', '.join(write_files[level] for level in outputs)))
 
-    ds.to_netcdf(write_file)
+    utils.write_outputs(
+        outputs,
+        write_files,
+        attrs=metadata,
+        skipna=skipna,
+        region_codes=region_codes,
+        table_dir=utils.WEB_REGION_TABLE_DIR)
 
     logger.debug('job done')
 
@@ -252,7 +297,13 @@ def job_test_filepaths(
         seasons,
         agglev,
         aggwt,
-        weights=None):
+        weights=None,
+        skipna=False,
+        regions=None,
+        region_codes=False,
+        partial=False,
+        chunks=None,
+        prefetch=1):
 
     # make sure the input data exist
 
@@ -266,13 +317,29 @@ def job_test_filepaths(
     WRITE_PATH.format(**metadata)
 
 
+def job_inputs(metadata, years, **kwargs):
+    '''
+    BCSD files read by a job, staged to node-local disk before it runs
+
+    Files that have been preprocessed (see ``preprocess_bcsd.py``) are not
+    staged.
+    '''
+
+    read_file = BCSD_orig_files.format(**metadata)
+
+    return [
+        read_file.format(year=y) for y in years
+        if not has_bcsd_store(read_file.format(year=y), metadata['variable'])]
+
+
 main = utils.slurm_runner(
     filepath=__file__,
     job_spec=JOB_SPEC,
     run_job=run_job,
     test_job=job_test_filepaths,
     onfinish=onfinish,
-    additional_metadata=ADDITIONAL_METADATA)
+    additional_metadata=ADDITIONAL_METADATA,
+    inputs=job_inputs)
 
 
 if __name__ == '__main__':
@@ -6,10 +6,21 @@ import xarray as xr
 import numpy as np
 import pandas as pd
 from scipy import interpolate
-from scipy.ndimage import label
+from scipy.ndimage import label, find_objects
 from scipy.interpolate import griddata
+from scipy.spatial import Delaunay, cKDTree
+from scipy import sparse
 from six import string_types
+import os
+import json
+import shutil
 import itertools
+import hashlib
+import multiprocessing
+import threading
+import tempfile
+import warnings
+import zipfile
 import toolz
 import datafs
 
@@ -17,6 +28,161 @@ WEIGHTS_FILE = (
     'GCP/spatial/world-combo-new/segment_weights/' +
     'agglomerated-world-new_BCSD_grid_segment_weights_area_pop.csv')
 
+CACHE_DIR = os.environ.get(
+    'CLIMATE_TOOLBOX_CACHE',
+    os.path.join(os.path.expanduser('~'), '.climate_toolbox'))
+
+STORE_DIR = os.environ.get(
+    'CLIMATE_TOOLBOX_STORE', os.path.join(CACHE_DIR, 'bcsd'))
+
+# Region tables must be readable by everyone decoding region-coded outputs,
+# so set this to a shared directory (or pass ``table_dir``) in production
+REGION_TABLE_DIR = os.environ.get(
+    'CLIMATE_TOOLBOX_REGION_TABLES', os.path.join(CACHE_DIR, 'regions'))
+
+# Layout version of the fill operators cached on disk. Bump whenever the
+# operator builders change, so that stale operators are not reused.
+_FILL_OPERATOR_VERSION = 2
+
+# Keys each kind of fill operator must provide
+_FILL_OPERATOR_KEYS = {
+    'linear': ('targets', 'sources', 'weights', 'nan_targets'),
+    'nearest': ('targets', 'nearest')}
+
+_FILL_OPERATORS = {}
+
+_FILL_POOLS = {}
+
+_FILL_POOL_LOCK = threading.Lock()
+
+_GRIDS = {}
+
+_AGGREGATION_OPERATORS = {}
+
+_GATHER_INDICES = {}
+
+_ROLLUPS = {}
+
+_REGION_CODES = {}
+
+
+class Grid(object):
+    '''
+    Describes a regular lat/lon grid
+
+    Grids are built once per distinct set of coordinates with
+    :py:func:`_get_grid` and shared by the fill, longitude standardization
+    and region reindexing stages.
+
+    Parameters
+    ----------
+    lat: np.array
+        1-D array of grid latitudes
+
+    lon: np.array
+        1-D array of grid longitudes
+
+    Attributes
+    ----------
+    lat, lon: np.array
+        read-only copies of the coordinates
+
+    shape: tuple
+        (len(lat), len(lon))
+
+    resolution: float
+        median latitude step (degrees)
+
+    lon_convention: str
+        ``'0:360'`` if any longitude is above 180, otherwise ``'-180:180'``
+
+    standard_lon: np.array
+        longitudes rescaled to -180:180, in the original order
+
+    lon_order: np.array
+        permutation that sorts ``standard_lon``
+
+    lon_sorted: bool
+        True if ``standard_lon`` is already sorted, so standardizing only
+        relabels the longitudes
+
+    is_standard: bool
+        True if the longitudes are already sorted in -180:180
+
+    signature: str
+        hex digest of the coordinates
+    '''
+
+    def __init__(self, lat, lon):
+        self.lat = np.array(lat, dtype='float64')
+        self.lon = np.array(lon, dtype='float64')
+        self.lat.flags.writeable = False
+        self.lon.flags.writeable = False
+
+        self.shape = (len(self.lat), len(self.lon))
+        self.signature = _grid_signature(self.lat, self.lon)
+
+        if len(self.lat) > 1:
+            self.resolution = float(np.median(np.abs(np.diff(self.lat))))
+        else:
+            self.resolution = np.nan
+
+        if (self.lon > 180).any():
+            self.lon_convention = '0:360'
+        else:
+            self.lon_convention = '-180:180'
+
+        self.standard_lon = np.where(
+            self.lon > 180, self.lon - 360, self.lon)
+        self.standard_lon.flags.writeable = False
+
+        self.lon_order = np.argsort(self.standard_lon, kind='mergesort')
+        self.lon_order.flags.writeable = False
+
+        self.lon_sorted = bool(
+            (self.lon_order == np.arange(len(self.lon))).all())
+
+        self.is_standard = (
+            (self.lon_convention == '-180:180') and self.lon_sorted)
+
+        self._mesh = None
+
+    @property
+    def mesh(self):
+        '''
+        (lat, lon) arrays of the cell centers, as returned by np.meshgrid
+        '''
+        if self._mesh is None:
+            lons, lats = np.meshgrid(self.lon, self.lat)
+            lats.flags.writeable = False
+            lons.flags.writeable = False
+            self._mesh = (lats, lons)
+
+        return self._mesh
+
+    def cell_index(self, pix_lat, pix_lon):
+        '''
+        (lat, lon) integer indices of pixel centers on the grid
+
+        Raises a ValueError if any pixel is not on the grid. See
+        :py:func:`_grid_cell_index`.
+        '''
+
+        cells = _grid_cell_index(self.lat, self.lon, pix_lat, pix_lon)
+
+        if (cells < 0).any():
+            raise ValueError(
+                '{} pixels not found on the grid'.format((cells < 0).sum()))
+
+        return cells // len(self.lon), cells % len(self.lon)
+
+    def __repr__(self):
+        return '<Grid {}x{} {} {}>'.format(
+            self.shape[0],
+            self.shape[1],
+            self.lon_convention,
+            self.signature[:8])
+
 '''
 =================
 Private Functions
@@ -24,6 +190,49 @@ Private Functions
 '''
 
 
+def _grid_signature(lat, lon):
+    '''
+    Returns a hex digest identifying a set of grid coordinates
+    '''
+    hasher = hashlib.sha1()
+
+    for arr in (lat, lon):
+        arr = np.ascontiguousarray(arr, dtype='float64')
+        hasher.update(str(arr.shape).encode('ascii'))
+        hasher.update(arr.tobytes())
+
+    return hasher.hexdigest()
+
+
+def _get_grid(lat, lon):
+    '''
+    Returns the :py:class:`Grid` for a set of coordinates
+
+    Grids are memoized on their signature, so repeated calls with the same
+    coordinates (e.g. for every file of a model) share precomputed meshes
+    and permutations.
+
+    Parameters
+    ----------
+    lat: np.array
+        1-D array of grid latitudes
+
+    lon: np.array
+        1-D array of grid longitudes
+
+    Returns
+    -------
+    Grid
+    '''
+
+    signature = _grid_signature(lat, lon)
+
+    if signature not in _GRIDS:
+        _GRIDS[signature] = Grid(lat, lon)
+
+    return _GRIDS[signature]
+
+
 def _fill_holes_xr(
         ds,
         varname,
@@ -32,7 +241,12 @@ def _fill_holes_xr(
         lat_name='lat',
         gridsize=0.25,
         minlat=-85,
-        maxlat=85):
+        maxlat=85,
+        engine='sparse',
+        cache_dir=CACHE_DIR,
+        workers=None,
+        required=None,
+        method='linear'):
     '''
     Fill NA values inplace in a gridded dataset
 
@@ -65,19 +279,311 @@ def _fill_holes_xr(
     minlon : float, optional
         latitude above which no values will be interpolated (default 85)
 
+    engine : str, optional
+        interpolation engine. ``'sparse'`` triangulates each distinct NaN
+        mask once and fills every slice sharing that mask with a sparse
+        matrix product. ``'griddata'`` calls :py:func:`_fill_holes` on each
+        slice (default 'sparse')
+
+    cache_dir : str, optional
+        directory in which sparse fill operators are stored, keyed on the
+        NaN mask and grid coordinates, so they can be reused by other files
+        and jobs. Set to None to disable the on-disk cache (default
+        ``CACHE_DIR``)
+
+    workers : int, optional
+        number of processes across which the sparse engine builds missing
+        fill operators: distinct NaN masks are built in parallel, and a
+        single mask's patches are triangulated in parallel. The operators
+        are applied in the current process. Ignored for lazy (dask) data, whose blocks are
+        filled by the dask scheduler as they are computed (default None,
+        builds in the current process)
+
+    required : np.array, optional
+        boolean (lat, lon) array of the cells that will be used downstream
+        (e.g. by the aggregation weights). NaN patches whose bounding box
+        contains no required cell are left unfilled (default None, fills
+        all patches)
+
+    method : str, optional
+        ``'linear'`` interpolates within the Delaunay triangulation of each
+        patch's bounding box. ``'nearest'`` copies the value of the nearest
+        valid cell (in lat/lon degrees), using a KD-tree built once per NaN
+        mask and cached as an index array (default 'linear')
+
+    Notes
+    -----
+    ``method='nearest'`` fills the same cells as ``'linear'`` but produces
+    a piecewise-constant field, so its error grows with distance from the
+    edge of each hole while ``'linear'`` blends the values around the
+    hole.
+
+    Measured on a synthetic daily temperature field (365 days on a 400 x
+    480 grid at 0.25 degrees, with smooth ~3 degree weather anomalies of
+    1.5 K standard deviation, and 5180 cells masked out in 600 rectangular
+    holes of 1-4 x 1-6 cells), against the masked-out true values:
+
+    ============  =========  ========  =========  =========  ========
+    engine        method     MAE (K)   RMSE (K)   max (K)    time (s)
+    ============  =========  ========  =========  =========  ========
+    griddata      linear     0.025     0.321      10.76      84.3
+    sparse        linear     0.025     0.321      10.76      1.3
+    sparse        nearest    0.133     0.495      16.23      1.4
+    ============  =========  ========  =========  =========  ========
+
+    The two linear engines agree exactly, and ``'nearest'`` has about five
+    times the mean absolute error of ``'linear'``. The order of magnitude
+    speedup over the per-slice ``griddata`` fill comes from the sparse
+    engine. Once an operator is built, ``'nearest'`` is no faster to apply
+    than ``'linear'``. It only saves the Delaunay triangulation, which
+    matters when there are many distinct NaN masks and no cached operators.
+    Use :py:func:`compare_fill_methods` to measure the difference between
+    the two methods on a given dataset before using ``'nearest'`` for
+    production output.
+
     '''
     if isinstance(broadcast_dims, string_types):
         broadcast_dims = (broadcast_dims, )
 
-    ravel_lons, ravel_lats = (
-        np.meshgrid(ds.coords[lon_name].values, ds.coords[lat_name].values))
+    if engine not in ('sparse', 'griddata'):
+        raise ValueError('fill engine not recognized: {}'.format(engine))
+
+    if method not in ('linear', 'nearest'):
+        raise ValueError('fill method not recognized: {}'.format(method))
+
+    grid = _get_grid(ds.coords[lat_name].values, ds.coords[lon_name].values)
+    ravel_lats, ravel_lons = grid.mesh
+
+    _remove_infinite_values(ds, varname)
+
+    if engine == 'griddata':
+        if _is_chunked(ds[varname]):
+            raise ValueError(
+                'the griddata fill engine requires data loaded into memory')
+
+        _fill_holes_by_slice(
+            ds,
+            varname,
+            broadcast_dims,
+            lat=ravel_lats,
+            lon=ravel_lons,
+            gridsize=gridsize,
+            minlat=minlat,
+            maxlat=maxlat,
+            required=required,
+            method=method)
+        return
+
+    da = ds[varname]
+    dims = tuple(broadcast_dims) + (lat_name, lon_name)
+
+    if sorted(da.dims) != sorted(dims):
+        raise ValueError(
+            'dimensions of {} {} do not match broadcast_dims + lat/lon {}'
+            .format(varname, da.dims, dims))
+
+    axes = [da.dims.index(d) for d in dims]
+
+    # lazy data is filled block by block as each chunk is computed. Every
+    # block holds whole lat/lon slices, so it is filled exactly as in memory
+    if _is_chunked(da):
+        data = da.data.rechunk({axes[-2]: -1, axes[-1]: -1})
+
+        ds[varname] = (
+            da.dims,
+            data.map_blocks(
+                _fill_block,
+                axes=axes,
+                lat=ravel_lats,
+                lon=ravel_lons,
+                gridsize=gridsize,
+                minlat=minlat,
+                maxlat=maxlat,
+                cache_dir=cache_dir,
+                required=required,
+                method=method,
+                dtype=data.dtype),
+            da.attrs)
+
+        return
+
+    _fill_array(
+        da.values,
+        axes,
+        lat=ravel_lats,
+        lon=ravel_lons,
+        gridsize=gridsize,
+        minlat=minlat,
+        maxlat=maxlat,
+        cache_dir=cache_dir,
+        workers=workers,
+        required=required,
+        method=method)
+
+
+def _fill_array(values, axes, lat, lon, **kwargs):
+    '''
+    Fills the NaN holes in an array of (lat, lon) slices inplace
+
+    ``axes`` are the positions of the broadcast dimensions followed by the
+    lat and lon dimensions in ``values``. Keyword arguments are passed to
+    :py:func:`_fill_holes_batch`.
+    '''
+
+    # reshape to (n_slices, n_cells) without leaving the underlying buffer
+    moved = np.moveaxis(values, axes, list(range(len(axes))))
+    flat = moved.reshape(-1, lat.size)
+
+    _fill_holes_batch(flat, lat=lat, lon=lon, **kwargs)
+
+    if not np.shares_memory(flat, values):
+        moved[...] = flat.reshape(moved.shape)
+
+
+def _fill_block(block, axes, lat, lon, **kwargs):
+    '''
+    Returns a filled copy of one block of a lazy (dask) array
+
+    Blocks are filled in the current thread; dask spreads the blocks across
+    its own workers.
+    '''
+
+    block = np.array(block, copy=True)
+    _fill_array(block, axes, lat, lon, **kwargs)
+
+    return block
+
+
+def _is_chunked(da):
+    '''
+    Whether a DataArray is backed by a lazy (dask) array
+    '''
+
+    return getattr(da.data, 'chunks', None) is not None
+
+
+def _chunk_slices(da, spatial_dims=('lat', 'lon')):
+    '''
+    Slices along the leading non-spatial dimension of a lazy DataArray
+
+    Returns the dimension name and one slice per dask chunk along it, or
+    ``(None, [])`` if the array has no non-spatial dimensions.
+    '''
+
+    other = [d for d in da.dims if d not in spatial_dims]
+
+    if len(other) == 0:
+        return None, []
+
+    dim = other[0]
+    sizes = da.chunks[da.dims.index(dim)]
+    bounds = np.cumsum((0, ) + tuple(sizes))
+
+    return dim, [slice(a, b) for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def _remove_infinite_values(ds, varname):
+    '''
+    Replaces infinite and fill (>= 1e10) values with NaN inplace
+    '''
 
-    # remove infinite values
     ds[varname] = (
         ds[varname]
             .where(~np.isinf(ds[varname]))
             .where(ds[varname] < 1e10))
 
+
+def compare_fill_methods(
+        ds,
+        varname,
+        broadcast_dims=('time',),
+        lon_name='lon',
+        lat_name='lat',
+        required=None):
+    '''
+    Compare nearest-neighbour and linear hole filling on a dataset
+
+    Fills copies of ``ds[varname]`` with ``method='linear'`` and
+    ``method='nearest'`` and summarizes the differences over the filled
+    cells. ``ds`` is not modified.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        dataset containing the variable to be filled
+
+    varname : str
+        name of the variable to be interpolated
+
+    broadcast_dims : tuple of strings, optional
+        tuple of dimension names to broadcast the interpolation step over
+        (default 'time')
+
+    lon_name : str, optional
+        name of the longitude dimension (default 'lon')
+
+    lat_name : str, optional
+        name of the latitude dimension (default 'lat')
+
+    required : np.array, optional
+        boolean (lat, lon) array of the cells that will be used downstream.
+        See :py:func:`_fill_holes_xr` (default None)
+
+    Returns
+    -------
+    stats : pd.Series
+        number of filled values and the mean absolute, root mean square
+        and maximum absolute difference between the two methods
+
+    '''
+
+    filled = {}
+
+    for method in ('linear', 'nearest'):
+        copy = xr.Dataset({varname: ds[varname].copy(deep=True)})
+
+        _fill_holes_xr(
+            copy,
+            varname,
+            broadcast_dims=broadcast_dims,
+            lon_name=lon_name,
+            lat_name=lat_name,
+            required=required,
+            method=method)
+
+        filled[method] = copy[varname]
+
+    before = ds[varname].transpose(*filled['linear'].dims).values
+    linear = filled['linear'].values
+    nearest = filled['nearest'].transpose(*filled['linear'].dims).values
+
+    compared = np.isnan(before) & ~np.isnan(linear) & ~np.isnan(nearest)
+    diff = (nearest - linear)[compared]
+
+    if diff.size == 0:
+        diff = np.array([np.nan])
+
+    return pd.Series(
+        [compared.sum(), np.abs(diff).mean(), np.sqrt((diff ** 2).mean()),
+            np.abs(diff).max()],
+        index=['n_filled', 'mean_abs_diff', 'rms_diff', 'max_abs_diff'])
+
+
+def _fill_holes_by_slice(
+        ds,
+        varname,
+        broadcast_dims,
+        lat,
+        lon,
+        gridsize=0.25,
+        minlat=-85,
+        maxlat=85,
+        required=None,
+        method='linear'):
+    '''
+    Fills each slice of a variable with :py:func:`_fill_holes`
+    '''
+
     for indexers in itertools.product(*tuple(
             [range(len(ds.coords[c])) for c in broadcast_dims])):
 
@@ -96,16 +602,225 @@ def _fill_holes_xr(
 
         filled = _fill_holes(
             var=np.ma.masked_invalid(sliced),
-            lat=ravel_lats,
-            lon=ravel_lons,
-            gridsize=0.25,
-            minlat=-85,
-            maxlat=85)
+            lat=lat,
+            lon=lon,
+            gridsize=gridsize,
+            minlat=minlat,
+            maxlat=maxlat,
+            required=required,
+            method=method)
 
         ds[varname][slicer_dict] = filled
 
 
-def _fill_holes(var, lat, lon, gridsize=0.25, minlat=-85, maxlat=85):
+def _fill_holes_batch(
+        flat,
+        lat,
+        lon,
+        gridsize=0.25,
+        minlat=-85,
+        maxlat=85,
+        cache_dir=CACHE_DIR,
+        workers=None,
+        required=None,
+        method='linear'):
+    '''
+    Fills NaN values inplace in a stack of flattened grids
+
+    Slices are grouped by NaN mask and each group is filled with a single
+    sparse matrix product using the operator for that mask.
+
+    Parameters
+    ----------
+    flat: np.array
+        2-D array of shape (n_slices, n_cells), modified inplace
+
+    lat: np.array
+        2-D array of latitude values
+
+    lon: np.array
+        2-D array of longitude values
+
+    gridsize: float
+        corresponds to degrees on the grid for climate data
+
+    minlat: float
+        corresponds to min latitude values to include. Used to remove poles
+
+    maxlat: float
+        corresponds to max lat values to include. Used to remove poles
+
+    cache_dir: str, optional
+        directory for persistent fill operators (default ``CACHE_DIR``)
+
+    workers: int, optional
+        number of worker processes used to build missing fill operators.
+        Distinct masks are built in parallel; a single mask (the usual
+        case for BCSD files) has its patches triangulated in parallel
+        instead (default None, builds in the current process)
+
+    required: np.array, optional
+        boolean array of cells used downstream. Patches that do not touch
+        a required cell are not filled (default None)
+
+    method: str, optional
+        interpolation method, 'linear' or 'nearest' (default 'linear')
+    '''
+
+    nans = np.isnan(flat)
+
+    groups = {}
+    for i in np.flatnonzero(nans.any(axis=1)):
+        groups.setdefault(_mask_signature(nans[i]), []).append(i)
+
+    groups = list(groups.values())
+
+    params = dict(
+        gridsize=gridsize,
+        minlat=minlat,
+        maxlat=maxlat,
+        required=required,
+        method=method)
+
+    # build the operators missing from memory in parallel, if there are
+    # several of them. A single mask (the usual case for BCSD files) is
+    # built below, with its patches triangulated across the workers.
+    if (workers is not None) and (workers > 1):
+        keys = [
+            _fill_operator_key(
+                nans[rows[0]].reshape(lat.shape), lat, lon, **params)
+            for rows in groups]
+
+        to_build = [
+            i for i, key in enumerate(keys) if key not in _FILL_OPERATORS]
+
+        if len(to_build) > 1:
+            built = _build_fill_operators_parallel(
+                [nans[groups[i][0]].reshape(lat.shape) for i in to_build],
+                lat=lat,
+                lon=lon,
+                params=params,
+                cache_dir=cache_dir,
+                workers=workers)
+
+            for i, operator in zip(to_build, built):
+                _FILL_OPERATORS[keys[i]] = operator
+
+    for rows in groups:
+        operator = _get_fill_operator(
+            mask=nans[rows[0]].reshape(lat.shape),
+            lat=lat,
+            lon=lon,
+            cache_dir=cache_dir,
+            workers=workers,
+            **params)
+
+        _apply_fill_operator(flat, np.array(rows), operator)
+
+
+def _build_fill_operators_parallel(
+        masks, lat, lon, params, cache_dir=CACHE_DIR, workers=2):
+    '''
+    Builds the fill operators of several NaN masks across worker processes
+
+    Only the masks and the grid's coordinate vectors are sent to the
+    workers, so the data itself is never copied. The pool is created once
+    per process and reused by later files (see :py:func:`_get_fill_pool`).
+
+    Parameters
+    ----------
+    masks: list
+        2-D boolean arrays, True where values are missing
+
+    lat: np.array
+        2-D array of latitude values
+
+    lon: np.array
+        2-D array of longitude values
+
+    params: dict
+        interpolation parameters (see :py:func:`_get_fill_operator`)
+
+    cache_dir: str, optional
+        directory for persistent fill operators (default ``CACHE_DIR``)
+
+    workers: int
+        number of worker processes
+
+    Returns
+    -------
+    list
+        fill operators, in the order of ``masks``
+    '''
+
+    pool = _get_fill_pool(workers)
+
+    return pool.map(
+        _build_fill_task,
+        [(np.packbits(mask), mask.shape, lat[:, 0], lon[0, :], params,
+            cache_dir)
+            for mask in masks])
+
+
+def _get_fill_pool(workers):
+    '''
+    Returns the process pool used to build fill operators
+
+    One pool per number of workers is kept for the life of the process,
+    so a job filling many files starts its workers once.
+
+    Workers are started from a ``forkserver`` (or ``spawn``) context rather
+    than forked. Files may be filled in a background thread (see
+    ``utils.prefetch``), and forking a multithreaded process can deadlock
+    the child.
+    '''
+
+    with _FILL_POOL_LOCK:
+        if workers not in _FILL_POOLS:
+            get_context = getattr(multiprocessing, 'get_context', None)
+
+            # python 2 only supports fork
+            if get_context is None:
+                context = multiprocessing
+
+            elif 'forkserver' in multiprocessing.get_all_start_methods():
+                context = get_context('forkserver')
+
+            else:
+                context = get_context('spawn')
+
+            _FILL_POOLS[workers] = context.Pool(workers)
+
+    return _FILL_POOLS[workers]
+
+
+def _build_fill_task(task):
+    '''
+    Builds (or loads) the fill operator of one NaN mask in a worker
+    '''
+
+    packed, shape, lat, lon, params, cache_dir = task
+
+    mask = np.unpackbits(packed)[:shape[0] * shape[1]].reshape(shape)
+    lats, lons = _get_grid(lat, lon).mesh
+
+    return _get_fill_operator(
+        mask=mask.astype(bool),
+        lat=lats,
+        lon=lons,
+        cache_dir=cache_dir,
+        **params)
+
+
+def _fill_holes(
+        var,
+        lat,
+        lon,
+        gridsize=0.25,
+        minlat=-85,
+        maxlat=85,
+        required=None,
+        method='linear'):
     '''
     Interpolates the missing values between points on grid
 
@@ -129,6 +844,13 @@ def _fill_holes(var, lat, lon, gridsize=0.25, minlat=-85, maxlat=85):
     maxlat: int
         corresponds to max lat values to include. Used to remove poles
 
+    required: np.array, optional
+        boolean array of cells used downstream. Patches whose bounding box
+        contains no required cell are not filled (default None)
+
+    method: str, optional
+        interpolation method passed to :py:func:`scipy.interpolate.griddata`
+        (default 'linear')
 
     '''
     # fill the missing value regions by linear interpolation
@@ -139,24 +861,12 @@ def _fill_holes(var, lat, lon, gridsize=0.25, minlat=-85, maxlat=85):
     if not var.mask[20: -20, :].any():
         return var
 
-    # fill the holes
-    var_filled = var[:]
-    missing = np.where((var.mask) & (lat > minlat) & (lat < maxlat))
-    mp = np.zeros(var.shape)
-    mp[missing] = 1
-    ptch, n_ptch = label(mp)
+    # fill the holes. Copy so that filled cells stay masked in `var` and
+    # are never used as interpolation points for later patches.
+    var_filled = var.copy()
+    ptch, n_ptch = label((var.mask) & (lat > minlat) & (lat < maxlat))
 
-    for p in range(1, n_ptch+1):
-
-        ind_ptch = np.where(ptch == p)
-        lat_ptch = lat[ind_ptch]
-        lon_ptch = lon[ind_ptch]
-
-        ind_box = np.where(
-                (lat <= np.max(lat_ptch)+gridsize) &
-                (lat >= np.min(lat_ptch)-gridsize) &
-                (lon <= np.max(lon_ptch)+gridsize) &
-                (lon >= np.min(lon_ptch)-gridsize))
+    for ind_box in _patch_boxes(ptch, n_ptch, lat, lon, gridsize, required):
 
         var_box = var[ind_box]
         lat_box = lat[ind_box]
@@ -168,133 +878,1235 @@ def _fill_holes(var, lat, lon, gridsize=0.25, minlat=-85, maxlat=85):
                 points,
                 values,
                 (lon_box, lat_box),
-                method='linear')
+                method=method)
 
     return var_filled
 
 
-def _standardize_longitude_dimension(ds, lon_names=['lon', 'longitude']):
+def _patch_boxes(ptch, n_ptch, lat, lon, gridsize=0.25, required=None):
     '''
-    Rescales the lat and lon coordinates to ensure lat is within (-90,90)
-    and lon is within (-180, 180). Renames coordinates
-    from lon to longitude and from lat to latitude. Sorts any new
-    rescaled coordinated.
+    Yields the bounding box of each labelled NaN patch
+
+    Boxes are found within a padded window around the patch's own slices
+    (from :py:func:`scipy.ndimage.find_objects`), so each patch only
+    touches its neighbourhood rather than the whole grid. Assumes ``lat``
+    and ``lon`` are meshes of monotonic coordinate vectors.
 
     Parameters
     ----------
-    ds: xarray.DataSet
+    ptch: np.array
+        array of patch labels, as returned by :py:func:`scipy.ndimage.label`
 
-    Returns
-    -------
-    ds: xarray.DataSet
+    n_ptch: int
+        number of patches
 
-    .. note:: this will be unnecessary if we standardize inputs. We can
-    scale the longitude dim to between (-180, 180)
+    lat: np.array
+        2-D array of latitude values
+
+    lon: np.array
+        2-D array of longitude values
+
+    gridsize: float
+        corresponds to degrees on the grid for climate data
+
+    required: np.array, optional
+        boolean array of cells used downstream. Boxes that contain no
+        required cell are skipped (default None)
 
+    Yields
+    ------
+    ind_box: tuple
+        tuple of (row, column) index arrays of the cells within ``gridsize``
+        of the patch's lat/lon extent, in row-major order
     '''
 
-    coords = np.array(ds.coords.keys())
+    pad = [
+        _window_padding(lat[:, 0], gridsize),
+        _window_padding(lon[0, :], gridsize)]
 
-    assert len(coords[np.in1d(coords, lon_names)]) == 1
-    _lon_coord = coords[np.in1d(coords, ['longitude', 'lon'])][0]
+    for p, window in enumerate(find_objects(ptch, n_ptch), 1):
 
-    ds = ds.rename({_lon_coord: '_longitude'})
+        window = tuple([
+            slice(max(w.start - pd, 0), w.stop + pd)
+            for w, pd in zip(window, pad)])
 
-    # Adjust lat and lon to make sure they are within (-90, 90) and (-180, 180)
-    ds['_longitude_adjusted'] = (
-        (ds._longitude - 360)
-            .where(ds._longitude > 180)
-            .fillna(ds._longitude))
+        lat_win = lat[window]
+        lon_win = lon[window]
 
-    # reassign the new coords to as the main lon coords
-    ds = (ds
-        .swap_dims({'_longitude': '_longitude_adjusted'})
-        .reindex({'_longitude_adjusted': sorted(ds._longitude_adjusted)}))
+        in_ptch = (ptch[window] == p)
+        lat_ptch = lat_win[in_ptch]
+        lon_ptch = lon_win[in_ptch]
 
-    if '_longitude' in ds.coords:
-        ds = ds.drop('_longitude')
+        rows, cols = np.where(
+                (lat_win <= np.max(lat_ptch)+gridsize) &
+                (lat_win >= np.min(lat_ptch)-gridsize) &
+                (lon_win <= np.max(lon_ptch)+gridsize) &
+                (lon_win >= np.min(lon_ptch)-gridsize))
 
-    ds = ds.rename({'_longitude_adjusted': _lon_coord})
+        ind_box = (rows + window[0].start, cols + window[1].start)
 
-    return ds
+        if (required is not None) and (not required[ind_box].any()):
+            continue
 
+        yield ind_box
 
-@toolz.memoize
-def _prepare_spatial_weights_data(weights_file=WEIGHTS_FILE):
+
+def _window_padding(coord, gridsize):
     '''
-    Rescales the pix_cent_x colum values
+    Number of cells along a coordinate vector spanning ``gridsize``
+    '''
+
+    if len(coord) < 2:
+        return 0
+
+    step = np.min(np.abs(np.diff(coord)))
+
+    return int(np.ceil(gridsize / step)) + 1
+
+
+def _mask_signature(mask, *arrays, **params):
+    '''
+    Returns a hex digest identifying a boolean mask
 
     Parameters
     ----------
-    weights_file: str
-        location of file used for weighting
+    mask: np.array
+        boolean array of missing values
 
+    arrays: np.array, optional
+        additional arrays (e.g. grid coordinates) to include in the digest
 
-    .. note:: unnecessary if we can standardize our input
+    params: optional
+        additional keyword parameters to include in the digest
+
+    Returns
+    -------
+    str
     '''
+    hasher = hashlib.sha1()
+    hasher.update(str(mask.shape).encode('ascii'))
+    hasher.update(np.packbits(mask).tobytes())
+
+    for arr in arrays:
+        hasher.update(np.ascontiguousarray(arr, dtype='float64').tobytes())
+
+    for k in sorted(params.keys()):
+        hasher.update('{}={!r};'.format(k, params[k]).encode('ascii'))
+
+    return hasher.hexdigest()
+
+
+def _get_fill_operator(
+        mask,
+        lat,
+        lon,
+        gridsize=0.25,
+        minlat=-85,
+        maxlat=85,
+        cache_dir=CACHE_DIR,
+        required=None,
+        method='linear',
+        workers=None):
+    '''
+    Retrieves a fill operator from the in-memory or on-disk cache
+
+    Operators are keyed on the NaN mask, the grid coordinates, the
+    required cells and the interpolation parameters. On a cache miss the
+    operator is built with :py:func:`_build_fill_operator` (or
+    :py:func:`_build_nearest_operator`) and written to ``cache_dir``.
+
+    Parameters
+    ----------
+    mask: np.array
+        boolean array, True where the climate values are missing
+
+    lat: np.array
+        array of latitude values
+
+    lon: np.array
+        array of longitude values
+
+    gridsize: float
+        corresponds to degrees on the grid for climate data
+
+    minlat: float
+        corresponds to min latitude values to include. Used to remove poles
+
+    maxlat: float
+        corresponds to max lat values to include. Used to remove poles
+
+    cache_dir: str, optional
+        directory for persistent fill operators. None disables the on-disk
+        cache (default ``CACHE_DIR``)
+
+    required: np.array, optional
+        boolean array of cells used downstream (default None)
+
+    method: str, optional
+        interpolation method, 'linear' or 'nearest' (default 'linear')
+
+    workers: int, optional
+        number of worker processes across which the patches of a linear
+        operator are triangulated (default None, builds in the current
+        process)
+
+    Returns
+    -------
+    operator: dict
+    '''
+
+    key = _fill_operator_key(
+        mask,
+        lat,
+        lon,
+        gridsize=gridsize,
+        minlat=minlat,
+        maxlat=maxlat,
+        required=required,
+        method=method)
+
+    if key in _FILL_OPERATORS:
+        return _FILL_OPERATORS[key]
+
+    operator = None
+
+    if cache_dir is not None:
+        fp = os.path.join(cache_dir, 'fill', '{}.npz'.format(key))
+        operator = _read_operator(fp, keys=_FILL_OPERATOR_KEYS[method])
+
+    if operator is None:
+        kwargs = dict(
+            mask=mask,
+            lat=lat,
+            lon=lon,
+            gridsize=gridsize,
+            minlat=minlat,
+            maxlat=maxlat,
+            required=required)
+
+        if method == 'nearest':
+            operator = _build_nearest_operator(**kwargs)
+
+        else:
+            operator = _build_fill_operator(workers=workers, **kwargs)
+
+        if cache_dir is not None:
+            _write_operator(fp, operator)
+
+    _FILL_OPERATORS[key] = operator
+
+    return operator
+
+
+def _fill_operator_key(
+        mask,
+        lat,
+        lon,
+        gridsize=0.25,
+        minlat=-85,
+        maxlat=85,
+        required=None,
+        method='linear'):
+    '''
+    Cache key of the fill operator for a NaN mask on a grid
+
+    The key includes ``_FILL_OPERATOR_VERSION``, so operators written by an
+    older layout are rebuilt rather than read.
+    '''
+
+    if required is not None:
+        required = _mask_signature(required)
+
+    return _mask_signature(
+        mask,
+        lat,
+        lon,
+        gridsize=gridsize,
+        minlat=minlat,
+        maxlat=maxlat,
+        required=required,
+        method=method,
+        version=_FILL_OPERATOR_VERSION)
+
+
+def _read_operator(fp, keys=()):
+    '''
+    Reads an operator written by :py:func:`_write_operator`
+
+    Returns None if the file does not exist, cannot be read or is missing
+    any of ``keys``
+    '''
+
+    if not os.path.isfile(fp):
+        return None
+
+    try:
+        with np.load(fp) as f:
+            operator = {k: f[k] for k in f.files}
+
+    except (IOError, OSError, ValueError, zipfile.BadZipfile):
+        return None
+
+    try:
+        if 'indptr' in operator:
+            operator['weights'] = sparse.csr_matrix(
+                (operator.pop('data'),
+                    operator.pop('indices'),
+                    operator.pop('indptr')),
+                shape=tuple(operator.pop('shape')))
+
+        if not all([k in operator for k in keys]):
+            return None
+
+        return operator
+
+    except (IOError, OSError, ValueError, KeyError, zipfile.BadZipfile):
+        return None
+
+
+def _write_operator(fp, operator):
+    '''
+    Writes a dict of arrays to an npz archive
+
+    A sparse matrix stored under ``weights`` is saved as its CSR
+    components. The archive is written to a temporary file and renamed
+    into place so that concurrent jobs never read a partially written
+    operator.
+    '''
+
+    if not os.path.isdir(os.path.dirname(fp)):
+        try:
+            os.makedirs(os.path.dirname(fp))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(fp)):
+                raise
+
+    arrays = dict(operator)
+
+    if 'weights' in arrays:
+        weights = arrays.pop('weights')
+        arrays.update(dict(
+            data=weights.data,
+            indices=weights.indices,
+            indptr=weights.indptr,
+            shape=np.array(weights.shape)))
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fp), suffix='.tmp')
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+
+        os.rename(tmp, fp)
+
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _build_fill_operator(
+        mask,
+        lat,
+        lon,
+        gridsize=0.25,
+        minlat=-85,
+        maxlat=85,
+        required=None,
+        workers=None):
+    '''
+    Builds a sparse linear operator reproducing :py:func:`_fill_holes`
+
+    Each NaN patch is triangulated once and the barycentric weights of the
+    missing cells in its bounding box are stored as rows of a sparse
+    (missing cells x valid cells) matrix. Where bounding boxes overlap, the
+    last patch wins, as in :py:func:`_fill_holes`.
+
+    Parameters
+    ----------
+    mask: np.array
+        boolean array, True where the climate values are missing
+
+    lat: np.array
+        array of latitude values
+
+    lon: np.array
+        array of longitude values
+
+    gridsize: float
+        corresponds to degrees on the grid for climate data
+
+    minlat: float
+        corresponds to min latitude values to include. Used to remove poles
+
+    maxlat: float
+        corresponds to max lat values to include. Used to remove poles
+
+    required: np.array, optional
+        boolean array of cells used downstream. Patches whose bounding box
+        contains no required cell are not filled (default None)
+
+    workers: int, optional
+        number of worker processes across which the patches are
+        triangulated (default None, triangulates in the current process)
+
+    Returns
+    -------
+    operator: dict
+        ``targets`` (flat indices of the filled cells), ``sources`` (flat
+        indices of the valid cells used for interpolation), ``weights`` (CSR
+        matrix of shape (len(targets), len(sources))) and ``nan_targets``
+        (flat indices of cells that fall outside the triangulation and are
+        filled with NaN)
+    '''
+
+    empty = dict(
+        targets=np.array([], dtype='int64'),
+        sources=np.array([], dtype='int64'),
+        weights=sparse.csr_matrix((0, 0)),
+        nan_targets=np.array([], dtype='int64'))
+
+    # nothing to fill, or the missing values are only in polar regions
+    if not mask[20: -20, :].any():
+        return empty
+
+    ptch, n_ptch = label(mask & (lat > minlat) & (lat < maxlat))
+
+    boxes = [
+        np.ravel_multi_index(box, mask.shape)
+        for box in _patch_boxes(ptch, n_ptch, lat, lon, gridsize, required)]
+
+    if len(boxes) == 0:
+        return empty
+
+    # triangulate runs of consecutive patches across the workers. The runs
+    # are concatenated in order, so the last patch still wins.
+    if (workers is not None) and (workers > 1) and (len(boxes) > 1):
+        runs = [
+            run for run in np.array_split(
+                np.arange(len(boxes)), min(len(boxes), 4 * workers))
+            if len(run) > 0]
+
+        parts = _get_fill_pool(workers).map(
+            _triangulate_task,
+            [(np.packbits(mask), mask.shape, lat[:, 0], lon[0, :],
+                [boxes[i] for i in run])
+                for run in runs],
+            chunksize=1)
+
+    else:
+        parts = [_triangulate_patches(boxes, mask, lat, lon)]
+
+    cells = np.concatenate([part[0] for part in parts])
+    vertices = np.concatenate([part[1] for part in parts])
+    barycentric = np.concatenate([part[2] for part in parts])
+
+    # keep the last assignment to each cell
+    _, last = np.unique(cells[::-1], return_index=True)
+    keep = len(cells) - 1 - last
+
+    cells = cells[keep]
+    vertices = vertices[keep]
+    barycentric = barycentric[keep]
+
+    outside = np.isnan(barycentric).any(axis=1)
+    barycentric[outside] = 0
+
+    sources, columns = np.unique(vertices.ravel(), return_inverse=True)
+
+    weights = sparse.csr_matrix(
+        (barycentric.ravel(),
+            (np.repeat(np.arange(len(cells)), 3), columns.ravel())),
+        shape=(len(cells), len(sources)))
+
+    return dict(
+        targets=cells,
+        sources=sources,
+        weights=weights,
+        nan_targets=cells[outside])
+
+
+def _triangulate_patches(boxes, mask, lat, lon):
+    '''
+    Barycentric interpolation weights of the missing cells of NaN patches
+
+    Parameters
+    ----------
+    boxes: list
+        flat cell indices of the bounding box of each patch (see
+        :py:func:`_patch_boxes`)
+
+    mask: np.array
+        boolean array, True where the climate values are missing
+
+    lat: np.array
+        2-D array of latitude values
+
+    lon: np.array
+        2-D array of longitude values
+
+    Returns
+    -------
+    cells, vertices, barycentric: np.array
+        flat indices of the missing cells in the boxes, in order, with the
+        flat indices of their three interpolation vertices and the
+        vertices' weights (NaN for cells outside the triangulation)
+    '''
+
+    flat_mask = mask.ravel()
+    flat_lat = lat.ravel()
+    flat_lon = lon.ravel()
+
+    cells = []
+    vertices = []
+    barycentric = []
+
+    for ind_box in boxes:
+
+        sources = ind_box[~flat_mask[ind_box]]
+        targets = ind_box[flat_mask[ind_box]]
+
+        tri = Delaunay(np.column_stack([flat_lon[sources], flat_lat[sources]]))
+        xi = np.column_stack([flat_lon[targets], flat_lat[targets]])
+
+        simplex = tri.find_simplex(xi)
+        transform = tri.transform[simplex]
+        b = np.einsum('ijk,ik->ij', transform[:, :2], xi - transform[:, 2])
+
+        bary = np.column_stack([b, 1 - b.sum(axis=1)])
+        bary[simplex == -1] = np.nan
+
+        cells.append(targets)
+        vertices.append(sources[tri.simplices[simplex]])
+        barycentric.append(bary)
+
+    return (
+        np.concatenate(cells),
+        np.concatenate(vertices),
+        np.concatenate(barycentric))
+
+
+def _triangulate_task(task):
+    '''
+    Triangulates a run of NaN patches in a worker
+    '''
+
+    packed, shape, lat, lon, boxes = task
+
+    mask = np.unpackbits(packed)[:shape[0] * shape[1]].reshape(shape)
+    lats, lons = _get_grid(lat, lon).mesh
+
+    return _triangulate_patches(boxes, mask.astype(bool), lats, lons)
+
+
+def _build_nearest_operator(
+        mask, lat, lon, gridsize=0.25, minlat=-85, maxlat=85, required=None):
+    '''
+    Builds a nearest-neighbour fill operator
+
+    Fills the same cells as :py:func:`_build_fill_operator`, copying the
+    value of the nearest valid cell (in lat/lon degrees) found with a
+    KD-tree over all valid cells.
+
+    Parameters
+    ----------
+    mask: np.array
+        boolean array, True where the climate values are missing
+
+    lat: np.array
+        array of latitude values
+
+    lon: np.array
+        array of longitude values
+
+    gridsize: float
+        corresponds to degrees on the grid for climate data
+
+    minlat: float
+        corresponds to min latitude values to include. Used to remove poles
+
+    maxlat: float
+        corresponds to max lat values to include. Used to remove poles
+
+    required: np.array, optional
+        boolean array of cells used downstream. Patches whose bounding box
+        contains no required cell are not filled (default None)
+
+    Returns
+    -------
+    operator: dict
+        ``targets`` (flat indices of the filled cells) and ``nearest``
+        (flat index of the valid cell each target is copied from)
+    '''
+
+    empty = dict(
+        targets=np.array([], dtype='int64'),
+        nearest=np.array([], dtype='int64'))
+
+    # nothing to fill, or the missing values are only in polar regions
+    if not mask[20: -20, :].any():
+        return empty
+
+    ptch, n_ptch = label(mask & (lat > minlat) & (lat < maxlat))
+
+    in_box = np.zeros(mask.shape, dtype=bool)
+    for box in _patch_boxes(ptch, n_ptch, lat, lon, gridsize, required):
+        in_box[box] = True
+
+    targets = np.flatnonzero(in_box & mask)
+    sources = np.flatnonzero(~mask)
+
+    if len(targets) == 0:
+        return empty
+
+    tree = cKDTree(np.column_stack([lon.ravel()[sources], lat.ravel()[sources]]))
+    _, nearest = tree.query(
+        np.column_stack([lon.ravel()[targets], lat.ravel()[targets]]))
+
+    return dict(targets=targets, nearest=sources[nearest])
+
+
+def _apply_fill_operator(flat, rows, operator):
+    '''
+    Fills missing values inplace using a precomputed fill operator
+
+    Parameters
+    ----------
+    flat: np.array
+        2-D array of shape (n_slices, n_cells), modified inplace
+
+    rows: np.array
+        indices of the slices in ``flat`` sharing the operator's NaN mask
+
+    operator: dict
+        fill operator created by :py:func:`_build_fill_operator` or
+        :py:func:`_build_nearest_operator`
+    '''
+
+    if len(operator['targets']) == 0:
+        return
+
+    if 'nearest' in operator:
+        flat[np.ix_(rows, operator['targets'])] = (
+            flat[np.ix_(rows, operator['nearest'])])
+        return
+
+    sources = flat[np.ix_(rows, operator['sources'])]
+
+    flat[np.ix_(rows, operator['targets'])] = (
+        operator['weights'].dot(sources.T).T)
+
+    flat[np.ix_(rows, operator['nan_targets'])] = np.nan
+
+
+def _standardize_longitude_dimension(ds, lon_names=['lon', 'longitude']):
+    '''
+    Rescales the lat and lon coordinates to ensure lat is within (-90,90)
+    and lon is within (-180, 180). Renames coordinates
+    from lon to longitude and from lat to latitude. Sorts any new
+    rescaled coordinated.
+
+    Parameters
+    ----------
+    ds: xarray.DataSet
+
+    Returns
+    -------
+    ds: xarray.DataSet
+
+    .. note:: this will be unnecessary if we standardize inputs. We can
+    scale the longitude dim to between (-180, 180)
+
+    Datasets that are already standardized are returned as is.
+
+    '''
+
+    coords = np.array(list(ds.coords.keys()))
+
+    assert len(coords[np.isin(coords, lon_names)]) == 1
+    _lon_coord = coords[np.isin(coords, ['longitude', 'lon'])][0]
+
+    # only the longitudes are reordered, so a latitude coordinate is used
+    # to share the memoized grid where there is one but is not required
+    _lat_coords = coords[np.isin(coords, ['latitude', 'lat'])]
+
+    if len(_lat_coords) > 0:
+        lat = ds.coords[_lat_coords[0]].values
+    else:
+        lat = np.array([])
+
+    grid = _get_grid(lat, ds.coords[_lon_coord].values)
+
+    if grid.is_standard:
+        return ds
+
+    # Reorder positionally with the grid's cached permutation, which
+    # copies the data once (indexing with an array never returns a view).
+    # Grids already in order once rescaled are only relabeled and keep
+    # sharing memory with the input.
+    if grid.lon_sorted:
+        ds = ds.copy(deep=False)
+    else:
+        ds = ds.isel(**{_lon_coord: grid.lon_order})
+
+    # Adjust lon to make sure it is within (-180, 180)
+    ds.coords[_lon_coord] = (
+        _lon_coord, grid.standard_lon[grid.lon_order])
+
+    return ds
+
+
+@toolz.memoize
+def _prepare_spatial_weights_data(
+        weights_file=WEIGHTS_FILE, cache_dir=CACHE_DIR, refresh=False):
+    '''
+    Rescales the pix_cent_x colum values
+
+    The prepared table is stored in ``cache_dir`` as one .npy array per
+    column. Once cached, the weights are read without contacting DataFS.
+
+    .. warning:: without ``refresh=True`` the cached table is returned
+       without checking its version, so a new version of the weights
+       archive is **not** picked up until the cache is refreshed or
+       deleted.
+
+    Parameters
+    ----------
+    weights_file: str
+        location of file used for weighting
+
+    cache_dir: str, optional
+        directory in which the prepared weights are cached. Set to None to
+        always read the weights from DataFS (default ``CACHE_DIR``)
+
+    refresh: bool, optional
+        check the cached weights against the latest version of the archive
+        and rebuild them if they are out of date (default False)
+
+
+    .. note:: unnecessary if we can standardize our input
+    '''
+
+    if cache_dir is None:
+        cache = None
+    else:
+        cache = os.path.join(
+            cache_dir,
+            'weights',
+            hashlib.sha1(weights_file.encode('utf-8')).hexdigest())
+
+    if (cache is not None) and (not refresh):
+        df = _read_weights_cache(cache)
+
+        if df is not None:
+            return df
 
     api = datafs.get_api()
     archive = api.get_archive(weights_file)
+    version = archive.get_latest_hash()
+
+    if cache is not None:
+        df = _read_weights_cache(cache, version=version)
+
+        if df is not None:
+            return df
 
     with archive.open('r') as f:
         df = pd.read_csv(f)
 
-    # Re-label out-of-bounds pixel centers
-    df.set_value((df['pix_cent_x'] == 180.125), 'pix_cent_x', -179.875)
+    # Re-label out-of-bounds pixel centers
+    df.set_value((df['pix_cent_x'] == 180.125), 'pix_cent_x', -179.875)
+
+    #probably totally unnecessary
+    df.drop_duplicates()
+    df.index.names = ['reshape_index']
+
+    df.rename(
+        columns={'pix_cent_x': 'lon', 'pix_cent_y': 'lat'},
+        inplace=True)
+
+    if cache is not None:
+        _write_weights_cache(cache, df, version=version)
+
+    return df
+
+
+def _read_weights_cache(cache, version=None):
+    '''
+    Reads weights written by :py:func:`_write_weights_cache`
+
+    Numeric columns and the index are memory-mapped read-only and wrapped
+    without copying. String columns are materialized as object arrays from
+    their codes. Returns None if the cache does not exist, cannot be read,
+    or (if ``version`` is given) was built from a different version of the
+    weights archive.
+    '''
+
+    try:
+        with open(os.path.join(cache, 'manifest.json'), 'r') as f:
+            manifest = json.load(f)
+
+        if (version is not None) and (manifest['version'] != version):
+            return None
+
+        def _load(name):
+            return np.load(
+                os.path.join(cache, '{}.npy'.format(name)), mmap_mode='r')
+
+        columns = {}
+        for i, col in enumerate(manifest['columns']):
+            if manifest['kinds'][i] == 'category':
+                # missing values have code -1, which indexes the final NaN
+                categories = np.append(
+                    np.asarray(_load('{}-categories'.format(i)), dtype=object),
+                    np.nan)
+                columns[col] = categories[_load('{}-codes'.format(i))]
+            else:
+                columns[col] = _load(i)
+
+        # copy=False keeps each column a view of its memory map instead of
+        # consolidating the columns into one in-memory block
+        df = pd.DataFrame(
+            columns,
+            columns=manifest['columns'],
+            index=pd.Index(
+                _load('index'), name=manifest['index_name'], copy=False),
+            copy=False)
+
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+    return df
+
+
+def _write_weights_cache(cache, df, version=None):
+    '''
+    Writes a weights table to ``cache`` as one .npy file per column
+
+    String columns are stored as integer codes plus an array of
+    categories. The directory is written to a temporary location and
+    renamed into place, so concurrent jobs never see a partial cache.
+    '''
+
+    parent = os.path.dirname(cache)
+
+    if not os.path.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            if not os.path.isdir(parent):
+                raise
+
+    tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+    stale = None
+
+    try:
+        def _save(name, arr):
+            np.save(os.path.join(tmp, '{}.npy'.format(name)), arr)
+
+        kinds = []
+        for i, col in enumerate(df.columns):
+            values = df[col].values
+
+            if values.dtype.kind == 'O':
+                codes, categories = pd.factorize(values)
+                _save('{}-codes'.format(i), codes.astype('int32'))
+                _save(
+                    '{}-categories'.format(i),
+                    np.asarray(categories, dtype='U'))
+                kinds.append('category')
+            else:
+                _save(i, values)
+                kinds.append('array')
+
+        _save('index', df.index.values)
+
+        with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+            json.dump(dict(
+                columns=[str(c) for c in df.columns],
+                kinds=kinds,
+                index_name=df.index.name,
+                version=version), f)
+
+        # move an out of date cache out of the way
+        if os.path.isdir(cache):
+            stale = tempfile.mkdtemp(dir=parent, prefix='.stale-')
+            try:
+                os.rename(cache, os.path.join(stale, 'weights'))
+            except OSError:
+                pass
+
+        try:
+            os.rename(tmp, cache)
+        except OSError:
+            # another job has written the cache in the meantime
+            if not os.path.isdir(cache):
+                raise
+
+    finally:
+        for d in (tmp, stale):
+            if (d is not None) and os.path.isdir(d):
+                shutil.rmtree(d)
+
+
+def _grid_cell_index(lat, lon, pix_lat, pix_lon, tol=1e-5):
+    '''
+    Finds the flat (lat, lon) cell index of each pixel center on a grid
+
+    Longitudes are compared modulo 360, so pixels given in -180:180 match
+    grids in either longitude convention.
+
+    Parameters
+    ----------
+    lat: np.array
+        1-D array of grid latitudes
+
+    lon: np.array
+        1-D array of grid longitudes
+
+    pix_lat: np.array
+        latitudes of the pixel centers to locate
+
+    pix_lon: np.array
+        longitudes of the pixel centers to locate
+
+    tol: float, optional
+        maximum distance (degrees) between a pixel center and its grid cell
+        (default 1e-5)
+
+    Returns
+    -------
+    np.array
+        flat index into a (len(lat), len(lon)) grid of each pixel, or -1 for
+        pixels that are not on the grid
+    '''
+
+    def _nearest(coord, values):
+        order = np.argsort(coord)
+        sorted_coord = coord[order]
+
+        pos = np.clip(
+            np.searchsorted(sorted_coord, values), 1, len(coord) - 1)
+
+        left = np.abs(values - sorted_coord[pos - 1])
+        right = np.abs(values - sorted_coord[pos])
+        pos = np.where(left <= right, pos - 1, pos)
+
+        matched = np.abs(values - sorted_coord[pos]) <= tol
+
+        return np.where(matched, order[pos], -1)
+
+    lat = np.asarray(lat, dtype='float64')
+    lon = np.mod(np.asarray(lon, dtype='float64'), 360)
+
+    ilat = _nearest(lat, np.asarray(pix_lat, dtype='float64'))
+    ilon = _nearest(lon, np.mod(np.asarray(pix_lon, dtype='float64'), 360))
+
+    return np.where(
+        (ilat >= 0) & (ilon >= 0), ilat * len(lon) + ilon, -1)
+
+
+def _required_cells(lat, lon, weights):
+    '''
+    Boolean (lat, lon) mask of the grid cells referenced by segment weights
+
+    Parameters
+    ----------
+    lat: np.array
+        1-D array of grid latitudes
+
+    lon: np.array
+        1-D array of grid longitudes
+
+    weights: pd.DataFrame
+        segment weights with ``lat`` and ``lon`` pixel center columns
+
+    Returns
+    -------
+    np.array
+    '''
+
+    cells = _grid_cell_index(lat, lon, weights.lat.values, weights.lon.values)
+
+    required = np.zeros(len(lat) * len(lon), dtype=bool)
+    required[cells[cells >= 0]] = True
+
+    return required.reshape(len(lat), len(lon))
+
+
+def _reindex_spatial_data_to_regions(ds, df):
+    '''
+    Reindexes spatial and segment weight data to regions
+
+    Enables region index-based math operations
+
+    Parameters
+    ----------
+    ds: xarray Dataset
+    df: pandas DataFrame
+
+    Returns
+    -------
+    Xarray DataArray
+
+
+    '''
+    grid = _get_grid(ds.lat.values, ds.lon.values)
+    cells, inverse = _get_gather_index(grid, df.lat.values, df.lon.values)
+
+    res = xr.Dataset(coords={
+        k: v for k, v in ds.coords.items()
+        if ('lat' not in v.dims) and ('lon' not in v.dims)})
+
+    for name, da in ds.data_vars.items():
+        if ('lat' not in da.dims) or ('lon' not in da.dims):
+            res[name] = da
+            continue
+
+        other = [d for d in da.dims if d not in ('lat', 'lon')]
+        values = da.transpose(*(other + ['lat', 'lon'])).values
+        values = values.reshape(values.shape[:-2] + (-1, ))
+
+        # gather each pixel once, then scatter to the segments using it
+        res[name] = (
+            other + ['reshape_index'],
+            np.take(np.take(values, cells, axis=-1), inverse, axis=-1))
+
+    res.coords['lat'] = (
+        'reshape_index', grid.lat[cells // grid.shape[1]][inverse])
+
+    res.coords['lon'] = (
+        'reshape_index', grid.lon[cells % grid.shape[1]][inverse])
+
+    return res
+
+
+def _get_gather_index(grid, pix_lat, pix_lon):
+    '''
+    Cached flat-index gather of pixel centers on a grid
+
+    Parameters
+    ----------
+    grid: Grid
+        grid of the data to be gathered
+
+    pix_lat: np.array
+        latitudes of the pixel centers
+
+    pix_lon: np.array
+        longitudes of the pixel centers
+
+    Returns
+    -------
+    cells: np.array
+        flat (lat, lon) index of each unique pixel on the grid
+
+    inverse: np.array
+        position in ``cells`` of each pixel
+    '''
+
+    key = _mask_signature(
+        np.zeros(0, dtype=bool), pix_lat, pix_lon, grid=grid.signature)
+
+    if key not in _GATHER_INDICES:
+        ilat, ilon = grid.cell_index(pix_lat, pix_lon)
+        _GATHER_INDICES[key] = np.unique(
+            ilat * grid.shape[1] + ilon, return_inverse=True)
+
+    return _GATHER_INDICES[key]
+
+
+def _aggregate_reindexed_data_to_regions(
+        ds,
+        variable,
+        aggwt,
+        agglev,
+        weights,
+        backup_aggwt='areawt',
+        skipna=False,
+        partial=False):
+    '''
+    Performs weighted avg for climate variable by region
+
+    Parameters
+    ----------
+
+    ds: xarray.DataArray
+
+    variable: str
+        name of the data variable
+
+    aggwt: str
+        variable to weight by (i.e popwt, areawt, cropwt)
+
+    agglev: str
+        indicates which regional id scheme to select in the dataframe
+
+    weight: pd.DataFrame
+        pandas DataFrame of weights
+
+    backup_aggwt: str, optional
+        aggregation weight to use in regions with no aggwt data (default
+        'areawt')
+
+    skipna: bool, optional
+        If True, NaN cells are treated as absent: each region's weights are
+        renormalized over the cells with valid data, and regions with no
+        valid cells are NaN. If False, NaN cells contribute nothing to the
+        weighted sum but their weight is kept in the denominator (default
+        False)
+
+    partial: bool, optional
+        return weighted sums and weight totals instead of weighted means.
+        See :py:func:`_regional_dataset` (default False)
+
+    '''
+
+    regions, order, starts = _get_region_codes(weights, agglev)
+
+    # format weights
+    wgt = weights[aggwt].where(weights[aggwt] > 0).fillna(
+        weights[backup_aggwt]).values.astype('float64')[order]
+
+    wgt[np.isnan(wgt)] = 0
+
+    da = ds[variable]
+    other = [d for d in da.dims if d != 'reshape_index']
+    values = da.transpose(*(other + ['reshape_index'])).values[..., order]
+
+    valid = ~np.isnan(values)
+
+    # sum each region's segments, which are contiguous in ``order``
+    num = np.add.reduceat(np.where(valid, values * wgt, 0), starts, axis=-1)
+
+    if skipna:
+        den = np.add.reduceat(np.where(valid, wgt, 0), starts, axis=-1)
+    else:
+        den = np.add.reduceat(wgt, starts)
+
+    coords = {d: da.coords[d] for d in other if d in da.coords}
+    coords[agglev] = regions
+
+    return _regional_dataset(
+        variable,
+        num,
+        np.broadcast_to(den, num.shape),
+        dims=other + [agglev],
+        coords=coords,
+        partial=partial)
+
+
+def _regional_dataset(variable, num, den, dims, coords, partial=False):
+    '''
+    Builds an aggregation result from regional weighted sums and totals
+
+    Parameters
+    ----------
+    variable: str
+        name of the data variable
+
+    num: np.array
+        weighted sum of the variable in each region
 
-    #probably totally unnecessary
-    df.drop_duplicates()
-    df.index.names = ['reshape_index']
+    den: np.array
+        total weight of each region, with the same shape as ``num``
 
-    df.rename(
-        columns={'pix_cent_x': 'lon', 'pix_cent_y': 'lat'},
-        inplace=True)
+    dims: list
+        dimension names of ``num`` and ``den``
 
-    return df
+    coords: dict
+        coordinates of the result
 
+    partial: bool, optional
+        If True, return the weighted sums and weight totals as
+        ``<variable>_wsum`` and ``<variable>_wtotal``. Partial results can
+        be combined with :py:func:`merge_partial_aggregates` and divided
+        with :py:func:`finalize_partial_aggregates`. If False, return the
+        weighted mean as ``variable``; regions with no (valid) weight are
+        NaN (default False)
 
-def _reindex_spatial_data_to_regions(ds, df):
+    Returns
+    -------
+    xarray.Dataset
     '''
-    Reindexes spatial and segment weight data to regions
 
-    Enables region index-based math operations
+    if partial:
+        return xr.Dataset({
+            '{}_wsum'.format(variable): xr.DataArray(
+                num, dims=dims, coords=coords),
+            '{}_wtotal'.format(variable): xr.DataArray(
+                np.array(den), dims=dims, coords=coords)})
+
+    # regions with no (valid) weight have a numerator and denominator of 0
+    mean = np.where(den > 0, num, np.nan) / np.where(den > 0, den, 1)
+
+    return xr.Dataset({
+        variable: xr.DataArray(mean, dims=dims, coords=coords)})
+
+
+def _get_region_codes(weights, agglev):
+    '''
+    Cached integer encoding of the segments' regions at one level
 
     Parameters
     ----------
-    ds: xarray Dataset
-    df: pandas DataFrame
+    weights: pd.DataFrame
+        segment weights
+
+    agglev: str
+        aggregation level (see :py:func:`_region_labels`)
 
     Returns
     -------
-    Xarray DataArray
+    regions: np.array
+        sorted region labels
 
+    order: np.array
+        positions of the segments with a region, sorted by region
 
+    starts: np.array
+        position in ``order`` of each region's first segment
     '''
-    res = ds.sel_points(
-        'reshape_index',
-        lat=df.lat.values,
-        lon=df.lon.values)
 
-    return res
+    key = _labels_signature(weights, agglev)
 
+    if key not in _REGION_CODES:
+        labels = _region_labels(weights, agglev)
+        keep = np.flatnonzero(labels.notnull().values)
 
-def _aggregate_reindexed_data_to_regions(
-        ds,
-        variable,
+        regions, codes = np.unique(
+            labels.values[keep].astype(object), return_inverse=True)
+
+        sorter = np.argsort(codes, kind='mergesort')
+
+        _REGION_CODES[key] = (
+            regions,
+            keep[sorter],
+            np.searchsorted(codes[sorter], np.arange(len(regions))))
+
+    return _REGION_CODES[key]
+
+
+def _get_aggregation_operator(
+        weights,
+        grid,
         aggwt,
         agglev,
-        weights,
-        backup_aggwt='areawt'):
+        backup_aggwt='areawt',
+        cache_dir=CACHE_DIR):
     '''
-    Performs weighted avg for climate variable by region
+    Retrieves a regions x cells aggregation operator
+
+    Operators are keyed on the grid and the weights columns they use, and
+    are cached in memory and in ``cache_dir``.
 
     Parameters
     ----------
+    weights: pd.DataFrame
+        segment weights with ``lat`` and ``lon`` pixel center columns
 
-    ds: xarray.DataArray
-
-    variable: str
-        name of the data variable
+    grid: Grid
+        grid of the data to be aggregated
 
     aggwt: str
         variable to weight by (i.e popwt, areawt, cropwt)
@@ -302,36 +2114,576 @@ def _aggregate_reindexed_data_to_regions(
     agglev: str
         indicates which regional id scheme to select in the dataframe
 
-    weight: pd.DataFrame
-        pandas DataFrame of weights
-
     backup_aggwt: str, optional
         aggregation weight to use in regions with no aggwt data (default
         'areawt')
 
+    cache_dir: str, optional
+        directory for persistent aggregation operators. None disables the
+        on-disk cache (default ``CACHE_DIR``)
+
+    Returns
+    -------
+    operator: dict
+        see :py:func:`_build_aggregation_operator`
+    '''
+
+    hasher = hashlib.sha1()
+    hasher.update(grid.signature.encode('ascii'))
+    hasher.update('{};{};{};'.format(
+        aggwt, agglev, backup_aggwt).encode('utf-8'))
+
+    for col in ('lat', 'lon', aggwt, backup_aggwt):
+        hasher.update(
+            np.ascontiguousarray(weights[col].values, dtype='float64')
+                .tobytes())
+
+    hasher.update(_labels_signature(weights, agglev).encode('ascii'))
+
+    key = hasher.hexdigest()
+
+    if key in _AGGREGATION_OPERATORS:
+        return _AGGREGATION_OPERATORS[key]
+
+    operator = None
+
+    if cache_dir is not None:
+        fp = os.path.join(cache_dir, 'aggregation', '{}.npz'.format(key))
+        operator = _read_operator(fp, keys=('weights', 'regions', 'empty', 'total'))
+
+    if operator is None:
+        operator = _build_aggregation_operator(
+            weights, grid, aggwt, agglev, backup_aggwt=backup_aggwt)
+
+        if cache_dir is not None:
+            _write_operator(fp, operator)
+
+    _AGGREGATION_OPERATORS[key] = operator
+
+    return operator
+
+
+def _build_aggregation_operator(
+        weights, grid, aggwt, agglev, backup_aggwt='areawt'):
     '''
+    Compiles segment weights into a sparse regions x cells matrix
 
-    ds.coords[agglev] = xr.DataArray(
-                weights[agglev].values,
-                dims={'reshape_index': weights.index.values})
+    Segments in the same region and grid cell are summed, and each row is
+    normalized by the region's total weight, so that the weighted average
+    of a field is a single matrix product. Weights that are missing or not
+    positive are replaced with ``backup_aggwt``, as in
+    :py:func:`_aggregate_reindexed_data_to_regions`.
 
-    # format weights
-    ds[aggwt] = xr.DataArray(
-                weights[aggwt].values,
-                dims={'reshape_index': weights.index.values})
+    Returns
+    -------
+    operator: dict
+        ``weights`` (CSR matrix, regions x cells), ``regions`` (sorted
+        region labels), ``empty`` (True for regions with no weight) and
+        ``total`` (total weight of each region)
+    '''
+
+    wgt = weights[aggwt].where(weights[aggwt] > 0).fillna(
+        weights[backup_aggwt]).values.astype('float64')
+
+    wgt[np.isnan(wgt)] = 0
+
+    labels = _region_labels(weights, agglev)
+    keep = labels.notnull().values
+
+    ilat, ilon = grid.cell_index(
+        weights.lat.values[keep], weights.lon.values[keep])
+
+    regions, rows = np.unique(
+        labels.values[keep].astype(object), return_inverse=True)
+
+    matrix = sparse.coo_matrix(
+        (wgt[keep], (rows, ilat * grid.shape[1] + ilon)),
+        shape=(len(regions), grid.shape[0] * grid.shape[1])).tocsr()
+
+    matrix.sum_duplicates()
+
+    total = np.asarray(matrix.sum(axis=1)).ravel()
+    empty = (total == 0)
+
+    scale = np.zeros(len(total))
+    scale[~empty] = 1.0 / total[~empty]
+
+    if regions.dtype.kind == 'O':
+        regions = regions.astype('U')
+
+    return dict(
+        weights=sparse.diags(scale).dot(matrix).tocsr(),
+        regions=regions,
+        empty=empty,
+        total=total)
+
+
+def _cell_values(ds, variable, cells=None):
+    '''
+    Gathers a gridded variable into a (slices, cells) array
+
+    The result is shared by every operator applied to the variable. Missing
+    values are replaced with 0 and tracked in ``valid``.
+
+    Parameters
+    ----------
+    ds: xarray.Dataset
+        dataset with ``lat`` and ``lon`` dimensions
+
+    variable: str
+        name of the data variable
+
+    cells: np.array, optional
+        flat (lat, lon) indices of the cells to gather (default None, all
+        cells)
+
+    Returns
+    -------
+    cells: dict
+        ``values`` and ``valid`` (slices x cells arrays), the gathered
+        ``cells``, and the ``dims``, ``shape`` and ``coords`` of the
+        non-spatial dimensions
+    '''
+
+    da = ds[variable]
+    other = [d for d in da.dims if d not in ('lat', 'lon')]
+    da = da.transpose(*(other + ['lat', 'lon']))
+
+    flat = da.values.reshape((-1, da.shape[-2] * da.shape[-1]))
+
+    if cells is not None:
+        flat = np.take(flat, cells, axis=-1)
+
+    valid = ~np.isnan(flat)
+
+    return dict(
+        values=np.where(valid, flat, 0),
+        valid=valid,
+        cells=cells,
+        dims=other,
+        shape=tuple([len(da[d]) for d in other]),
+        coords={d: da.coords[d] for d in other if d in da.coords})
+
+
+def _aggregate_cells(
+        cells,
+        variable,
+        weights,
+        grid,
+        aggwt,
+        agglevs,
+        skipna=False,
+        cache_dir=CACHE_DIR,
+        base_agglev='hierid',
+        partial=False):
+    '''
+    Aggregates gathered cell values to one or more levels with one weight
+
+    If several levels are requested, the values are aggregated once to
+    ``base_agglev`` and rolled up to every level that nests within it.
+    Other levels are aggregated directly.
+
+    Returns
+    -------
+    results: dict
+        Datasets keyed on level
+    '''
+
+    results = {}
+
+    if (len(agglevs) > 1) and (base_agglev in weights.columns):
+        operator = _get_aggregation_operator(
+            weights, grid, aggwt, base_agglev, cache_dir=cache_dir)
+
+        rollups = {}
+        for level in agglevs:
+            if level == base_agglev:
+                continue
+
+            rollup = _get_rollup(
+                weights, operator['regions'], base_agglev, level)
+
+            if rollup is not None:
+                rollups[level] = rollup
+
+        results = _apply_aggregation_operator(
+            cells,
+            variable,
+            operator,
+            base_agglev,
+            skipna=skipna,
+            rollups=rollups,
+            partial=partial)
+
+        if base_agglev not in agglevs:
+            results.pop(base_agglev)
+
+    for level in agglevs:
+        if level not in results:
+            operator = _get_aggregation_operator(
+                weights, grid, aggwt, level, cache_dir=cache_dir)
+
+            results[level] = _apply_aggregation_operator(
+                cells,
+                variable,
+                operator,
+                level,
+                skipna=skipna,
+                partial=partial)
+
+    return results
+
+
+def _apply_aggregation_operator(
+        cells,
+        variable,
+        operator,
+        agglev,
+        skipna=False,
+        rollups=None,
+        partial=False):
+    '''
+    Aggregates a gridded variable with a regions x cells operator
+
+    Parameters
+    ----------
+    cells: dict
+        variable values gathered with :py:func:`_cell_values` on the
+        operator's grid
+
+    variable: str
+        name of the data variable
+
+    operator: dict
+        operator created by :py:func:`_build_aggregation_operator`
+
+    agglev: str
+        name of the region dimension in the result
+
+    skipna: bool, optional
+        renormalize over cells with valid data. See
+        :py:func:`_aggregate_reindexed_data_to_regions` (default False)
+
+    rollups: dict, optional
+        coarser levels to aggregate to from the operator's regions, as
+        returned by :py:func:`_get_rollup`, keyed on level name. Regional
+        weighted sums and weight totals are summed to each level, which is
+        equivalent to aggregating to it directly (default None)
+
+    partial: bool, optional
+        return weighted sums and weight totals instead of weighted means.
+        See :py:func:`_regional_dataset` (default False)
+
+    Returns
+    -------
+    weighted: xarray.Dataset
+        if ``rollups`` is None, otherwise a dict of Datasets keyed on
+        ``agglev`` and each rollup level
+    '''
+
+    matrix = operator['weights']
+
+    if cells['cells'] is not None:
+        matrix = matrix[:, cells['cells']]
+    other = cells['dims']
+    shape = cells['shape']
+
+    # missing cells contribute nothing to the weighted sum
+    res = matrix.dot(cells['values'].T)
+
+    # share of each region's weight that is used
+    if skipna:
+        norm = matrix.dot(cells['valid'].T.astype('float64'))
+    else:
+        norm = (~operator['empty']).astype('float64')[:, np.newaxis]
+
+    total = operator['total'][:, np.newaxis]
+
+    def _dataset(num, den, regions, level):
+        if regions.dtype.kind == 'U':
+            regions = regions.astype(object)
+
+        coords = dict(cells['coords'])
+        coords[level] = regions
+
+        return _regional_dataset(
+            variable,
+            num.T.reshape(shape + (len(regions), )),
+            np.broadcast_to(den, num.shape).T.reshape(
+                shape + (len(regions), )),
+            dims=other + [level],
+            coords=coords,
+            partial=partial)
+
+    if partial:
+        weighted = _dataset(
+            res * total, norm * total, operator['regions'], agglev)
+    else:
+        weighted = _dataset(res, norm, operator['regions'], agglev)
+
+    if rollups is None:
+        return weighted
+
+    results = {agglev: weighted}
+
+    for level, (parents, mapping) in rollups.items():
+        results[level] = _dataset(
+            mapping.dot(res * total),
+            mapping.dot(norm * total),
+            parents,
+            level)
+
+    return results
+
+
+def _region_labels(weights, agglev):
+    '''
+    Region label of each segment for an aggregation level
+
+    ``agglev`` is either a column of ``weights`` or a prefix level of a
+    hierarchical id column, written ``'<column>:<depth>'``. For example
+    ``'hierid:2'`` labels each segment with the first two dot-separated
+    components of its hierid (``'USA.9'``).
+    '''
+
+    if agglev in weights.columns:
+        return weights[agglev]
+
+    column, sep, depth = agglev.rpartition(':')
+
+    if (not sep) or (column not in weights.columns) or (not depth.isdigit()):
+        raise ValueError('aggregation level not recognized: {}'.format(agglev))
+
+    return (
+        weights[column]
+            .str.split('.')
+            .str[:int(depth)]
+            .str.join('.'))
+
+
+def _labels_signature(weights, agglev):
+    '''
+    Hex digest of the weights column an aggregation level is derived from
+    '''
+    column = agglev if agglev in weights.columns else agglev.rpartition(':')[0]
+
+    return hashlib.sha1(
+        '{};'.format(agglev).encode('utf-8') +
+        pd.util.hash_array(weights[column].values.astype(object)).tobytes()
+        ).hexdigest()
+
+
+def _get_rollup(weights, regions, base, level):
+    '''
+    Cached mapping from the regions of one level to a coarser level
+
+    Parameters
+    ----------
+    weights: pd.DataFrame
+        segment weights
+
+    regions: np.array
+        sorted region labels at level ``base``
+
+    base: str
+        aggregation level of ``regions``
+
+    level: str
+        coarser aggregation level (see :py:func:`_region_labels`)
+
+    Returns
+    -------
+    rollup: tuple or None
+        sorted labels at ``level`` and a sparse (parents x regions)
+        indicator matrix, or None if ``level`` does not nest within ``base``
+    '''
+
+    key = hashlib.sha1(
+        pd.util.hash_array(np.asarray(regions, dtype=object)).tobytes() +
+        _labels_signature(weights, base).encode('ascii') +
+        _labels_signature(weights, level).encode('ascii')).hexdigest()
+
+    if key in _ROLLUPS:
+        return _ROLLUPS[key]
+
+    pairs = (
+        pd.DataFrame({
+            'child': _region_labels(weights, base).values,
+            'parent': _region_labels(weights, level).values})
+        .dropna()
+        .drop_duplicates())
+
+    rollup = None
+
+    if not pairs.child.duplicated().any():
+        mapping = pairs.set_index('child').parent.reindex(
+            np.asarray(regions, dtype=object))
+
+        known = mapping.notnull().values
+        parents, rows = np.unique(
+            mapping.values[known].astype(object), return_inverse=True)
+
+        rollup = (
+            parents,
+            sparse.csr_matrix(
+                (np.ones(len(rows)), (rows, np.flatnonzero(known))),
+                shape=(len(parents), len(regions))))
+
+    _ROLLUPS[key] = rollup
+
+    return rollup
+
+
+def _open_dataset(fp, variables=None, window=None, chunks=None):
+    '''
+    Opens a netCDF file, reading only the requested variables and window
+
+    Variables other than ``variables``, their dimensions and the lat/lon
+    coordinates are dropped before they are decoded, and the window is
+    selected before any data is read, so only that hyperslab is loaded
+    from disk.
+
+    Parameters
+    ----------
+    fp : str
+        path to the netCDF file
+
+    variables : list, optional
+        data variables to read (default None, all variables)
+
+    window : dict, optional
+        ``(min, max)`` bounds keyed on coordinate name (see
+        :py:func:`_select_window`) (default None, the full grid)
+
+    chunks : dict, optional
+        dask chunks. If given, the data is left lazy (default None, loads
+        the selection into memory)
+
+    Returns
+    -------
+    xr.Dataset
+    '''
+
+    drop = None
+
+    if variables is not None:
+        keep = set(variables) | set(['lat', 'lon', 'latitude', 'longitude'])
+
+        with xr.open_dataset(fp, decode_cf=False) as raw:
+            for var in variables:
+                keep.update(raw[var].dims)
+
+            drop = [v for v in raw.variables if v not in keep]
+
+    if chunks is not None:
+        return _select_window(
+            xr.open_dataset(fp, drop_variables=drop, chunks=chunks), window)
+
+    with xr.open_dataset(fp, drop_variables=drop) as raw:
+        ds = _select_window(raw, window)
+        ds.load()
+
+    return ds
+
+
+def _select_window(ds, window=None):
+    '''
+    Selects the cells of a dataset that fall within coordinate bounds
+
+    Each coordinate is read as one contiguous index range (the first to the
+    last cell within its bounds), so the selection maps onto a single
+    netCDF hyperslab. Longitude bounds are compared in -180:180, whichever
+    convention the data uses.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+
+    window : dict, optional
+        ``(min, max)`` bounds keyed on coordinate name, e.g.
+        ``{'lat': (-56, 84)}``. Coordinates may be stored as data
+        variables along another dimension (e.g. ``lat`` along ``nlat``)
+        (default None, returns ``ds`` unchanged)
+
+    Returns
+    -------
+    xr.Dataset
+    '''
+
+    if window is None:
+        return ds
+
+    selection = {}
+
+    for name, (lower, upper) in window.items():
+        coord = ds[name]
+        values = coord.values
+
+        if name in ('lon', 'longitude'):
+            values = (values + 180) % 360 - 180
+
+        inside = np.flatnonzero((values >= lower) & (values <= upper))
+
+        if len(inside) == 0:
+            raise ValueError(
+                'no {} values found within window ({}, {})'.format(
+                    name, lower, upper))
+
+        selection[coord.dims[0]] = slice(inside[0], inside[-1] + 1)
+
+    return ds.isel(**selection)
+
+
+def _bcsd_store_path(fp, varname, store_dir=STORE_DIR):
+    '''
+    Directory of the preprocessed store of a raw BCSD file
+
+    Stores are keyed on the file name, so a staged copy of a file finds the
+    same store as the original.
+    '''
+
+    return os.path.join(
+        store_dir, varname, os.path.splitext(os.path.basename(fp))[0])
+
+
+def _read_bcsd_store(fp, varname, store_dir=STORE_DIR):
+    '''
+    Reads a store written by :py:func:`write_bcsd_store`
+
+    The data are memory-mapped read-only, so only the pages that are used
+    are read from disk. Returns None if there is no store, it cannot be
+    read, or its size and modification time do not match the raw file.
+    '''
+
+    if store_dir is None:
+        return None
 
-    ds[aggwt] = ds[aggwt].where(ds[aggwt] > 0).fillna(weights[backup_aggwt].values)
+    store = _bcsd_store_path(fp, varname, store_dir)
 
-    weighted = xr.Dataset({
-        variable: (
-            (ds[variable]*ds[aggwt])
-                .groupby(agglev)
-                .sum(dim='reshape_index') /
-            ds[aggwt]
-                .groupby(agglev)
-                .sum(dim='reshape_index'))})
+    try:
+        with open(os.path.join(store, 'manifest.json'), 'r') as f:
+            manifest = json.load(f)
 
-    return weighted
+        if os.path.isfile(fp):
+            stat = os.stat(fp)
+
+            if ((manifest['source_size'] != stat.st_size)
+                    or (manifest['source_mtime'] != int(stat.st_mtime))):
+                return None
+
+        values = np.load(
+            os.path.join(store, '{}.npy'.format(varname)), mmap_mode='r')
+
+        with xr.open_dataset(os.path.join(store, 'coords.nc')) as coords:
+            coords.load()
+
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+    ds = coords.copy()
+    ds[varname] = (tuple(manifest['dims']), values, manifest['attrs'])
+
+    return ds
 
 
 '''
@@ -340,17 +2692,36 @@ Public Functions
 ================
 '''
 
-def load_bcsd(fp, varname, lon_name='lon', broadcast_dims=('time',)):
+def load_bcsd(
+        fp,
+        varname,
+        lon_name='lon',
+        broadcast_dims=('time',),
+        workers=None,
+        weights=None,
+        required=None,
+        fill=True,
+        standardize_lon=True,
+        chunks=None,
+        window=None,
+        variables=None,
+        method='linear',
+        store_dir=STORE_DIR):
     '''
     Read and prepare climate data
 
-    After reading data, this method also fills NA values using linear
-    interpolation, and standardizes longitude to -180:180
+    After reading data, this method also fills NA values (by default using
+    linear interpolation), and standardizes longitude to -180:180
+
+    If the file has been preprocessed with :py:func:`write_bcsd_store`,
+    ``fill`` is True, ``method`` is ``'linear'`` and ``variables`` is
+    ``[varname]``, the filled, standardized data are memory-mapped from the
+    store instead, with no filling or reordering.
 
     Parameters
     ----------
-    fp: str
-        File path to dataset
+    fp: str or xr.Dataset
+        File path to dataset, or an open dataset to prepare
 
     varname: str
         Variable name to be read
@@ -359,32 +2730,139 @@ def load_bcsd(fp, varname, lon_name='lon', broadcast_dims=('time',)):
         Name of the longitude dimension (defualt selects from ['lon' or
         'longitude'])
 
+    workers : int, optional
+        number of processes used to build fill operators missing from the
+        cache (see :py:func:`_fill_holes_xr`). Filling itself runs in the
+        current process (default None, builds in the current process)
+
+    weights : pd.DataFrame, optional
+        Segment weights the data will be aggregated with. If provided, only
+        NA patches near pixels referenced by the weights are filled (default
+        None, fills all NA values)
+
+    required : np.array, optional
+        Boolean (lat, lon) mask of the cells to fill around, on the grid of
+        the file as read. Overrides ``weights`` (default None)
+
+    fill : bool, optional
+        Fill NA values. If False, infinite values are set to NA and holes
+        are left in place, e.g. for aggregation with ``skipna=True`` in
+        :py:func:`weighted_aggregate_grid_to_regions` (default True)
+
+    standardize_lon : bool, optional
+        Rescale and sort longitudes to -180:180. Data that is only passed to
+        :py:func:`weighted_aggregate_grid_to_regions` can be left on its
+        native grid, which avoids copying it (default True)
+
+    chunks : dict, optional
+        Open the file lazily with these dask chunks (e.g. ``{'time': 30}``)
+        instead of loading it into memory. Holes are filled and longitudes
+        reordered chunk by chunk as the data is computed, and
+        :py:func:`weighted_aggregate_grid_to_regions` computes one chunk at
+        a time, so peak memory scales with the chunk size rather than the
+        file size. The lat and lon dimensions are always read whole
+        (default None, loads the file into memory)
+
+    window : dict, optional
+        ``(min, max)`` coordinate bounds to return, keyed on ``lat`` and/or
+        ``lon``, e.g. from :py:func:`weights_window`. If ``fill`` is False,
+        cells outside the window are never read from disk. Otherwise the
+        full grid is read and filled and the window selected afterwards, so
+        the filled values do not depend on the window (default None, the
+        full grid)
+
+    variables : list, optional
+        Data variables to read. Other variables are dropped before they are
+        decoded (default None, reads all variables)
+
+    method : str, optional
+        Fill method, ``'linear'`` or ``'nearest'``. See
+        :py:func:`_fill_holes_xr` for the accuracy of each (default
+        'linear')
+
+    store_dir : str, optional
+        directory of preprocessed stores (see :py:func:`write_bcsd_store`).
+        Set to None to always read the raw file (default ``STORE_DIR``)
+
     Returns
     -------
     xr.Dataset
-         xarray dataset loaded into memory
+         xarray dataset loaded into memory, or backed by dask arrays if
+         ``chunks`` is given
     '''
 
     if lon_name is not None:
         lon_names = [lon_name]
 
-    if hasattr(fp, 'sel_points'):
-        ds = fp
+    if (fill and (method == 'linear') and isinstance(fp, string_types)
+            and (variables is not None) and (list(variables) == [varname])):
+
+        stored = _read_bcsd_store(fp, varname, store_dir)
+
+        if stored is not None:
+            stored = _select_window(stored, window)
+
+            if chunks is not None:
+                stored = stored.chunk(chunks)
+
+            return stored
+
+    # holes are filled from the cells around them, so filled data is read
+    # on the full grid and the window is selected once the holes are filled
+    read_window = None if fill else window
+
+    if isinstance(fp, xr.Dataset):
+        ds = _select_window(fp, read_window)
+
+        if variables is not None:
+            ds = ds[list(variables)]
+
+    else:
+        ds = _open_dataset(
+            fp, variables=variables, window=read_window, chunks=chunks)
+
+    if not fill:
+        _remove_infinite_values(ds, varname)
 
     else:
-        with xr.open_dataset(fp) as ds:
-            ds.load()
+        if (required is None) and (weights is not None):
+            required = _required_cells(ds.lat.values, ds.lon.values, weights)
+
+        _fill_holes_xr(
+            ds,
+            varname,
+            broadcast_dims=broadcast_dims,
+            workers=workers,
+            required=required,
+            method=method)
+
+        ds = _select_window(ds, window)
+
+    if not standardize_lon:
+        return ds
 
-    _fill_holes_xr(ds, varname, broadcast_dims=broadcast_dims)
     return _standardize_longitude_dimension(ds, lon_names=lon_names)
 
 
-def load_baseline(fp, varname, lon_name='lon', broadcast_dims=None):
+def load_baseline(
+        fp,
+        varname,
+        lon_name='lon',
+        broadcast_dims=None,
+        workers=None,
+        weights=None,
+        required=None,
+        fill=True,
+        standardize_lon=True,
+        chunks=None,
+        window=None,
+        variables=None,
+        method='linear'):
     '''
     Read and prepare climate data
 
-    After reading data, this method also fills NA values using linear
-    interpolation, and standardizes longitude to -180:180
+    After reading data, this method also fills NA values (by default using
+    linear interpolation), and standardizes longitude to -180:180
 
     Parameters
     ----------
@@ -398,10 +2876,61 @@ def load_baseline(fp, varname, lon_name='lon', broadcast_dims=None):
         Name of the longitude dimension (defualt selects from ['lon' or
         'longitude'])
 
+    workers : int, optional
+        number of processes used to build fill operators missing from the
+        cache (see :py:func:`_fill_holes_xr`). Filling itself runs in the
+        current process (default None, builds in the current process)
+
+    weights : pd.DataFrame, optional
+        Segment weights the data will be aggregated with. If provided, only
+        NA patches near pixels referenced by the weights are filled (default
+        None, fills all NA values)
+
+    required : np.array, optional
+        Boolean (lat, lon) mask of the cells to fill around, on the grid of
+        the file as read. Overrides ``weights`` (default None)
+
+    fill : bool, optional
+        Fill NA values. If False, infinite values are set to NA and holes
+        are left in place, e.g. for aggregation with ``skipna=True`` in
+        :py:func:`weighted_aggregate_grid_to_regions` (default True)
+
+    standardize_lon : bool, optional
+        Rescale and sort longitudes to -180:180. Data that is only passed to
+        :py:func:`weighted_aggregate_grid_to_regions` can be left on its
+        native grid, which avoids copying it (default True)
+
+    chunks : dict, optional
+        Open the file lazily with these dask chunks (e.g. ``{'time': 30}``)
+        instead of loading it into memory. Holes are filled and longitudes
+        reordered chunk by chunk as the data is computed, and
+        :py:func:`weighted_aggregate_grid_to_regions` computes one chunk at
+        a time, so peak memory scales with the chunk size rather than the
+        file size. The lat and lon dimensions are always read whole
+        (default None, loads the file into memory)
+
+    window : dict, optional
+        ``(min, max)`` coordinate bounds to return, keyed on ``lat`` and/or
+        ``lon``, e.g. from :py:func:`weights_window`. If ``fill`` is False,
+        cells outside the window are never read from disk. Otherwise the
+        full grid is read and filled and the window selected afterwards, so
+        the filled values do not depend on the window (default None, the
+        full grid)
+
+    variables : list, optional
+        Data variables to read. Other variables are dropped before they are
+        decoded (default None, reads all variables)
+
+    method : str, optional
+        Fill method, ``'linear'`` or ``'nearest'``. See
+        :py:func:`_fill_holes_xr` for the accuracy of each (default
+        'linear')
+
     Returns
     -------
     xr.Dataset
-         xarray dataset loaded into memory
+         xarray dataset loaded into memory, or backed by dask arrays if
+         ``chunks`` is given
     '''
 
     if lon_name is not None:
@@ -410,8 +2939,12 @@ def load_baseline(fp, varname, lon_name='lon', broadcast_dims=None):
     if broadcast_dims is None:
         broadcast_dims = tuple([])
 
-    with xr.open_dataset(fp) as ds:
-        ds.load()
+    # holes are filled from the cells around them, so filled data is read
+    # on the full grid and the window is selected once the holes are filled
+    read_window = None if fill else window
+
+    ds = _open_dataset(
+        fp, variables=variables, window=read_window, chunks=chunks)
 
     if 'lat' in ds.data_vars:
         ds = ds.set_coords('lat')
@@ -421,15 +2954,203 @@ def load_baseline(fp, varname, lon_name='lon', broadcast_dims=None):
         ds = ds.set_coords('lon')
         ds = ds.swap_dims({'nlon': 'lon'})
 
-    _fill_holes_xr(ds, varname, broadcast_dims=broadcast_dims)
+    if not fill:
+        _remove_infinite_values(ds, varname)
+
+    else:
+        if (required is None) and (weights is not None):
+            required = _required_cells(ds.lat.values, ds.lon.values, weights)
+
+        _fill_holes_xr(
+            ds,
+            varname,
+            broadcast_dims=broadcast_dims,
+            workers=workers,
+            required=required,
+            method=method)
+
+        ds = _select_window(ds, window)
+
+    if not standardize_lon:
+        return ds
+
     return _standardize_longitude_dimension(ds, lon_names=lon_names)
 
+
+def write_bcsd_store(fp, varname, store_dir=STORE_DIR, workers=None):
+    '''
+    Preprocesses a raw BCSD file into a store read by :py:func:`load_bcsd`
+
+    All holes are filled and longitudes standardized to -180:180. The
+    variable is written as an uncompressed .npy array in its on-disk
+    dimension order, so each time slice is contiguous and any run of time
+    steps can be memory-mapped. The coordinates and attributes are written
+    to a small netCDF file. The store is written to a temporary directory
+    and renamed into place, so readers never see a partial store.
+
+    Parameters
+    ----------
+    fp : str
+        path to the raw BCSD file
+
+    varname : str
+        variable to preprocess
+
+    store_dir : str, optional
+        directory of preprocessed stores (default ``STORE_DIR``)
+
+    workers : int, optional
+        number of processes used to build fill operators missing from the
+        cache (default None)
+
+    Returns
+    -------
+    str
+        path of the store
+    '''
+
+    store = _bcsd_store_path(fp, varname, store_dir)
+    stat = os.stat(fp)
+
+    ds = load_bcsd(
+        fp,
+        varname,
+        workers=workers,
+        variables=[varname],
+        store_dir=None)
+
+    da = ds[varname]
+
+    parent = os.path.dirname(store)
+
+    if not os.path.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            if not os.path.isdir(parent):
+                raise
+
+    tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+    stale = None
+
+    try:
+        np.save(
+            os.path.join(tmp, '{}.npy'.format(varname)),
+            np.ascontiguousarray(da.values))
+
+        xr.Dataset(coords=da.coords, attrs=ds.attrs).to_netcdf(
+            os.path.join(tmp, 'coords.nc'))
+
+        with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+            json.dump(dict(
+                dims=list(da.dims),
+                attrs={
+                    k: (v.tolist() if hasattr(v, 'tolist') else v)
+                    for k, v in da.attrs.items()},
+                source_size=stat.st_size,
+                source_mtime=int(stat.st_mtime)), f)
+
+        # move an out of date store out of the way
+        if os.path.isdir(store):
+            stale = tempfile.mkdtemp(dir=parent, prefix='.stale-')
+            try:
+                os.rename(store, os.path.join(stale, 'store'))
+            except OSError:
+                pass
+
+        try:
+            os.rename(tmp, store)
+        except OSError:
+            # another job has written the store in the meantime
+            if not os.path.isdir(store):
+                raise
+
+    finally:
+        for d in (tmp, stale):
+            if (d is not None) and os.path.isdir(d):
+                shutil.rmtree(d)
+
+    return store
+
+
+def has_bcsd_store(fp, varname, store_dir=STORE_DIR):
+    '''
+    Whether :py:func:`load_bcsd` will read ``fp`` from an up to date store
+
+    Use this to skip staging or reading raw files that have been
+    preprocessed.
+    '''
+
+    if store_dir is None:
+        return False
+
+    store = _bcsd_store_path(fp, varname, store_dir)
+
+    try:
+        with open(os.path.join(store, 'manifest.json'), 'r') as f:
+            manifest = json.load(f)
+
+    except (IOError, OSError, ValueError):
+        return False
+
+    if not os.path.isfile(fp):
+        return True
+
+    stat = os.stat(fp)
+
+    return (
+        (manifest.get('source_size') == stat.st_size)
+        and (manifest.get('source_mtime') == int(stat.st_mtime)))
+
+
+def load_segment_weights(
+        weights_file=WEIGHTS_FILE, cache_dir=CACHE_DIR, refresh=False):
+    '''
+    Reads the segment weights used to aggregate gridded data to regions
+
+    Parameters
+    ----------
+    weights_file : str, optional
+        DataFS archive name of the segment weights (default
+        agglomerated-world-new BCSD segment weights)
+
+    cache_dir : str, optional
+        directory in which the prepared weights are cached as memory-mapped
+        arrays. Cached weights are read without contacting DataFS. Set to
+        None to disable the cache (default ``CACHE_DIR``)
+
+    refresh : bool, optional
+        check the cached weights against the latest archive version and
+        rebuild them if needed (default False)
+
+    .. warning:: the cached weights are **not** checked against the
+       archive unless ``refresh=True``. After a new version of the weights
+       archive is published, run once with ``refresh=True`` (or delete
+       ``cache_dir/weights``), otherwise every job keeps aggregating with
+       the old weights.
+
+    Returns
+    -------
+    pd.DataFrame
+        segment weights with ``lat`` and ``lon`` pixel center columns
+    '''
+
+    return _prepare_spatial_weights_data(
+        weights_file, cache_dir=cache_dir, refresh=refresh)
+
+
 def weighted_aggregate_grid_to_regions(
         ds,
         variable,
         aggwt,
         agglev,
-        weights=None):
+        weights=None,
+        skipna=False,
+        engine='sparse',
+        cache_dir=CACHE_DIR,
+        base_agglev='hierid',
+        partial=False,
+        regions=None):
     '''
     Computes the weighted reshape of gridded data
 
@@ -437,38 +3158,588 @@ def weighted_aggregate_grid_to_regions(
     ----------
     ds : xr.Dataset
         xarray Dataset to be aggregated. Must have 'lat' and 'lon' in the
-        coordinates.
+        coordinates. Longitudes may be in either -180:180 or 0:360; the
+        weights' pixels are matched to the data's own grid, so the data
+        does not need to be standardized first. Lazy (dask-backed) data is
+        computed and aggregated one chunk at a time along its leading
+        non-spatial dimension.
 
     variable : str
         name of the variable to be aggregated
 
-    aggwt : str
+    aggwt : str or list
         Weighting variable (e.g. 'popwt', 'areawt'). This must be a column name
-        in the weights file.
+        in the weights file. If a list of weights is given, the results are
+        concatenated along a ``weighting`` dimension.
 
-    agglev : str
+    agglev : str or list
         Target regional aggregation level (e.g. 'ISO', 'hierid'). This must be
-        a column name in the weights file.
+        a column name in the weights file, or a hierid prefix level such as
+        ``'hierid:2'`` (see :py:func:`_region_labels`). If a list of levels is
+        given, a dict of datasets keyed on level is returned.
 
     weights : str, optional
         Regional aggregation weights (default agglomerated-world-new BCSD
         segment weights)
 
+    skipna : bool, optional
+        Treat NaN cells as absent, renormalizing each region's weights over
+        its valid cells. Regions with no valid cells are NaN. Use with
+        ``fill=False`` in :py:func:`load_bcsd` to aggregate without
+        interpolating holes (default False)
+
+    engine : str, optional
+        ``'sparse'`` compiles the weights into a sparse regions x cells
+        matrix, cached per weights, grid, aggwt and agglev, and aggregates
+        with one matrix product. ``'reduceat'`` gathers the weighted pixels
+        and sums them by region with a segment reduction
+        (``np.add.reduceat``). ``'groupby'`` is a deprecated alias of
+        ``'reduceat'`` (default 'sparse')
+
+    cache_dir : str, optional
+        directory in which compiled aggregation operators are stored. Set
+        to None to disable the on-disk cache (default ``CACHE_DIR``)
+
+    base_agglev : str, optional
+        When several levels are requested with the sparse engine, the data
+        is aggregated once to this level and rolled up to every level that
+        nests within it. Other levels are aggregated directly (default
+        'hierid')
+
+    partial : bool, optional
+        Return each region's weighted sum (``<variable>_wsum``) and weight
+        total (``<variable>_wtotal``) instead of the weighted mean. Partial
+        results from spatial tiles, batches of years or separate jobs can
+        be added with :py:func:`merge_partial_aggregates` and divided with
+        :py:func:`finalize_partial_aggregates` (default False)
+
+    regions : list, optional
+        Region labels to aggregate to. Only the segments of these regions
+        are used, so only the pixels they cover are gathered. Each level
+        returns the listed regions found at that level, and is empty if
+        there are none. Raises a ValueError if no level has any of them
+        (default None, all regions)
+
     Returns
     -------
-    ds: xr.Dataset
-        weighted and averaged dataset based on agglev
+    ds: xr.Dataset or dict
+        weighted and averaged dataset based on agglev, or a dict of datasets
+        keyed on level if a list of levels is given
     '''
 
     if weights is None:
         weights = _prepare_spatial_weights_data()
 
-    ds = _reindex_spatial_data_to_regions(ds, weights)
-    ds = _aggregate_reindexed_data_to_regions(
-        ds,
-        variable,
-        aggwt,
+    if engine == 'groupby':
+        warnings.warn(
+            "engine='groupby' is deprecated, use engine='reduceat'",
+            DeprecationWarning,
+            stacklevel=2)
+
+        engine = 'reduceat'
+
+    if engine not in ('sparse', 'reduceat'):
+        raise ValueError(
+            'aggregation engine not recognized: {}'.format(engine))
+
+    if isinstance(aggwt, string_types):
+        aggwts = [aggwt]
+    else:
+        aggwts = list(aggwt)
+
+    if isinstance(agglev, string_types):
+        agglevs = [agglev]
+    else:
+        agglevs = list(agglev)
+
+    # compute lazy data one chunk at a time and stitch the results together
+    if _is_chunked(ds[variable]):
+        dim, slices = _chunk_slices(ds[variable])
+
+        kwargs = dict(
+            weights=weights,
+            skipna=skipna,
+            engine=engine,
+            cache_dir=cache_dir,
+            base_agglev=base_agglev,
+            partial=partial,
+            regions=regions)
+
+        if dim is None:
+            return weighted_aggregate_grid_to_regions(
+                ds[[variable]].load(), variable, aggwt, agglev, **kwargs)
+
+        parts = [
+            weighted_aggregate_grid_to_regions(
+                ds[[variable]].isel(**{dim: s}).load(),
+                variable,
+                aggwt,
+                agglev,
+                **kwargs)
+            for s in slices]
+
+        if isinstance(agglev, string_types):
+            return xr.concat(parts, dim=dim)
+
+        return {
+            level: xr.concat([part[level] for part in parts], dim=dim)
+            for level in agglevs}
+
+    if regions is not None:
+        regions = list(regions)
+
+        # aggregate every level (rolling up from base_agglev) using the
+        # segments of the listed regions at any level. Regions that contain
+        # a listed region but are not listed themselves may be incomplete,
+        # so each level keeps only its listed regions.
+        results = weighted_aggregate_grid_to_regions(
+            ds,
+            variable,
+            aggwt,
+            agglevs,
+            weights=select_region_weights(weights, agglevs, regions),
+            skipna=skipna,
+            engine=engine,
+            cache_dir=cache_dir,
+            base_agglev=base_agglev,
+            partial=partial)
+
+        results = {
+            level: res.isel(**{level: np.flatnonzero(
+                np.isin(res[level].values, regions))})
+            for level, res in results.items()}
+
+        if isinstance(agglev, string_types):
+            return results[agglev]
+
+        return results
+
+    # gather the pixel values once for all weightings and levels
+    if engine == 'sparse':
+        grid = _get_grid(ds.lat.values, ds.lon.values)
+
+        # only the cells referenced by the weights are read
+        used, _ = _get_gather_index(
+            grid, weights.lat.values, weights.lon.values)
+        cells = _cell_values(ds, variable, cells=used)
+
+        by_weight = [
+            _aggregate_cells(
+                cells,
+                variable,
+                weights,
+                grid,
+                wgt,
+                agglevs,
+                skipna=skipna,
+                cache_dir=cache_dir,
+                base_agglev=base_agglev,
+                partial=partial)
+            for wgt in aggwts]
+
+    else:
+        ds = _reindex_spatial_data_to_regions(ds, weights)
+
+        by_weight = [
+            {level: _aggregate_reindexed_data_to_regions(
+                    ds,
+                    variable,
+                    wgt,
+                    level,
+                    weights,
+                    skipna=skipna,
+                    partial=partial)
+                for level in agglevs}
+            for wgt in aggwts]
+
+    results = {}
+    for level in agglevs:
+        if isinstance(aggwt, string_types):
+            results[level] = by_weight[0][level]
+        else:
+            results[level] = xr.concat(
+                [res[level] for res in by_weight],
+                dim=pd.Index(aggwts, name='weighting'))
+
+    if isinstance(agglev, string_types):
+        return results[agglev]
+
+    return results
+
+
+def select_region_weights(weights, agglev, regions):
+    '''
+    Selects the segment weights of a set of regions
+
+    Parameters
+    ----------
+    weights : pd.DataFrame
+        segment weights
+
+    agglev : str or list
+        aggregation level(s) of the region labels (see
+        :py:func:`weighted_aggregate_grid_to_regions`)
+
+    regions : list
+        region labels. Segments belonging to any of these regions at any of
+        the levels are kept.
+
+    Returns
+    -------
+    pd.DataFrame
+        the weights of the selected segments. Passing these to
+        :py:func:`load_bcsd` and :py:func:`weighted_aggregate_grid_to_regions`
+        limits hole filling and aggregation to the pixels they use.
+    '''
+
+    if isinstance(agglev, string_types):
+        agglev = [agglev]
+
+    regions = list(regions)
+
+    keep = np.zeros(len(weights), dtype=bool)
+    for level in agglev:
+        keep |= _region_labels(weights, level).isin(regions).values
+
+    if not keep.any():
+        raise ValueError(
+            'none of the regions {} found at level {}'.format(
+                regions, ', '.join(agglev)))
+
+    return weights[keep]
+
+
+def weights_window(weights, padding=2.0):
+    '''
+    Latitude and longitude bounds of the pixels used by segment weights
+
+    Passing the window to :py:func:`load_bcsd` or :py:func:`load_baseline`
+    returns only the rows and columns the aggregation needs. Unfilled data
+    (``fill=False``) is read only within the window, leaving e.g. the polar
+    rows on disk. Filled data is read and filled on the full grid first,
+    because clipping the grid changes how holes are filled.
+
+    Parameters
+    ----------
+    weights : pd.DataFrame
+        segment weights, e.g. from :py:func:`load_segment_weights` or
+        :py:func:`select_region_weights`
+
+    padding : float, optional
+        degrees added on each side of the weighted pixels (default 2.0)
+
+    Returns
+    -------
+    dict
+        ``(min, max)`` bounds keyed on ``lat`` and ``lon``. Longitudes are
+        in -180:180.
+    '''
+
+    lats = weights.lat.values
+    lons = (weights.lon.values + 180) % 360 - 180
+
+    window = {
+        'lat': (lats.min() - padding, lats.max() + padding),
+        'lon': (lons.min() - padding, lons.max() + padding)}
+
+    # a window wider than the globe would not select any fewer columns
+    if (window['lon'][0] <= -180) or (window['lon'][1] >= 180):
+        del window['lon']
+
+    return window
+
+
+def prepare_aggregation(agglev, weights=None, skipna=False, regions=None):
+    '''
+    Weights, fill flag and read window for a job aggregating gridded data
+
+    Parameters
+    ----------
+    agglev : str or list
+        target aggregation level(s). Levels starting with ``'grid'`` are
+        written on the grid and need no weights
+
+    weights : pd.DataFrame, optional
+        segment weights (default :py:func:`load_segment_weights`)
+
+    skipna : bool, optional
+        aggregate with ``skipna=True``, leaving holes unfilled (default
+        False)
+
+    regions : list, optional
+        only aggregate to these regions (see
+        :py:func:`select_region_weights`)
+
+    Returns
+    -------
+    weights : pd.DataFrame
+        weights to fill around and aggregate with, or None for gridded
+        output
+
+    fill : bool
+        whether holes should be filled when the data are loaded
+
+    window : dict
+        bounds of the grid the weights use (see :py:func:`weights_window`),
+        or None for gridded output
+    '''
+
+    if isinstance(agglev, string_types):
+        agglev = [agglev]
+
+    gridded = any([level.startswith('grid') for level in agglev])
+
+    # aggregating with skipna treats holes as missing instead of filling them
+    fill = not (skipna and not gridded)
+
+    if gridded:
+        return weights, fill, None
+
+    # only fill holes near pixels used in the regional aggregation
+    if weights is None:
+        weights = load_segment_weights()
+
+    # only gather, fill and aggregate the pixels the target regions use
+    if regions is not None:
+        weights = select_region_weights(weights, agglev, regions)
+
+    # only read the rows and columns of the grid the weights use
+    window = weights_window(weights)
+
+    return weights, fill, window
+
+
+def merge_partial_aggregates(partials):
+    '''
+    Adds partial regional aggregates together
+
+    Parameters
+    ----------
+    partials : list
+        Datasets returned by :py:func:`weighted_aggregate_grid_to_regions`
+        with ``partial=True``, e.g. for different spatial tiles or batches
+        of years. Regions missing from some partials are treated as having
+        no weight in them.
+
+    Returns
+    -------
+    ds : xr.Dataset
+        summed weighted sums and weight totals
+    '''
+
+    partials = list(partials)
+
+    if len(partials) == 1:
+        return partials[0]
+
+    return xr.concat(partials, dim='_partial').sum(dim='_partial')
+
+
+def finalize_partial_aggregates(ds, variable):
+    '''
+    Divides merged partial aggregates into regional weighted means
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        partial aggregates, as returned by
+        :py:func:`weighted_aggregate_grid_to_regions` with ``partial=True``
+        or :py:func:`merge_partial_aggregates`
+
+    variable : str
+        name of the aggregated variable
+
+    Returns
+    -------
+    ds : xr.Dataset
+        weighted means, NaN in regions with no (valid) weight
+    '''
+
+    num = ds['{}_wsum'.format(variable)]
+    den = ds['{}_wtotal'.format(variable)]
+
+    return xr.Dataset({variable: num.where(den > 0) / den.where(den > 0)})
+
+
+def get_region_table(agglev, weights=None, table_dir=REGION_TABLE_DIR):
+    '''
+    Sorted table of the region labels at an aggregation level
+
+    Integer region codes written by :py:func:`encode_regions` are positions
+    in this table. The table is versioned by a digest of its labels and
+    saved in ``table_dir`` so readers can decode files with
+    :py:func:`load_region_table`. Save it alongside the outputs (or in
+    another directory their readers can access), not in a per-user cache.
+
+    Parameters
+    ----------
+    agglev : str
+        aggregation level (e.g. 'ISO', 'hierid')
+
+    weights : pd.DataFrame, optional
+        segment weights defining the regions (default agglomerated-world-new
+        BCSD segment weights)
+
+    table_dir : str, optional
+        directory in which region tables are saved. None disables saving
+        (default ``REGION_TABLE_DIR``)
+
+    Returns
+    -------
+    table : pd.Index
+    '''
+
+    if weights is None:
+        weights = _prepare_spatial_weights_data()
+
+    regions, _, _ = _get_region_codes(weights, agglev)
+    table = pd.Index(regions, name=agglev)
+
+    if table_dir is not None:
+        fp = _region_table_path(
+            agglev, _region_table_version(table), table_dir)
+
+        if not os.path.isfile(fp):
+            if not os.path.isdir(os.path.dirname(fp)):
+                try:
+                    os.makedirs(os.path.dirname(fp))
+                except OSError:
+                    if not os.path.isdir(os.path.dirname(fp)):
+                        raise
+
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fp), suffix='.tmp')
+
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write('\n'.join(map(str, table)) + '\n')
+
+                os.rename(tmp, fp)
+
+            except Exception:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+
+    return table
+
+
+def load_region_table(agglev, version, table_dir=REGION_TABLE_DIR):
+    '''
+    Reads a region table saved by :py:func:`get_region_table`
+
+    Parameters
+    ----------
+    agglev : str
+        aggregation level
+
+    version : str
+        table version, as stored in the ``region_table`` attribute of
+        encoded region coordinates
+
+    table_dir : str, optional
+        directory in which the writer saved its region tables (default
+        ``REGION_TABLE_DIR``)
+
+    Returns
+    -------
+    table : pd.Index
+    '''
+
+    with open(_region_table_path(agglev, version, table_dir), 'r') as f:
+        labels = f.read().splitlines()
+
+    table = pd.Index(np.array(labels, dtype=object), name=agglev)
+
+    if _region_table_version(table) != version:
+        raise ValueError(
+            'region table for {} does not match version {}'.format(
+                agglev, version))
+
+    return table
+
+
+def _region_table_version(table):
+    '''
+    Hex digest of the labels in a region table
+    '''
+    return hashlib.sha1(
+        '\n'.join(map(str, table)).encode('utf-8')).hexdigest()
+
+
+def _region_table_path(agglev, version, table_dir=REGION_TABLE_DIR):
+    return os.path.join(table_dir, '{}-{}.txt'.format(agglev, version))
+
+
+def encode_regions(ds, agglev, table):
+    '''
+    Replaces a region label coordinate with int32 codes into a region table
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        dataset with an ``agglev`` dimension of region labels
+
+    agglev : str
+        name of the region dimension
+
+    table : pd.Index
+        region table returned by :py:func:`get_region_table`
+
+    Returns
+    -------
+    ds : xr.Dataset
+        dataset with int32 region codes. The table version is stored in the
+        ``region_table`` attribute of the coordinate.
+    '''
+
+    codes = table.get_indexer(ds[agglev].values)
+
+    if (codes < 0).any():
+        raise ValueError(
+            '{} regions not found in the {} region table'.format(
+                (codes < 0).sum(), agglev))
+
+    ds = ds.copy()
+    ds.coords[agglev] = (
         agglev,
-        weights)
+        codes.astype('int32'),
+        {'region_table': _region_table_version(table)})
+
+    return ds
+
+
+def decode_regions(ds, agglev, version=None, table_dir=REGION_TABLE_DIR):
+    '''
+    Replaces int32 region codes with the labels of their region table
+
+    Parameters
+    ----------
+    ds : xr.Dataset or xr.DataArray
+        data with an ``agglev`` dimension encoded by
+        :py:func:`encode_regions`
+
+    agglev : str
+        name of the region dimension
+
+    version : str, optional
+        region table version (default the ``region_table`` attribute of the
+        coordinate)
+
+    table_dir : str, optional
+        directory in which the writer saved its region tables (default
+        ``REGION_TABLE_DIR``)
+
+    Returns
+    -------
+    ds : xr.Dataset or xr.DataArray
+    '''
+
+    if version is None:
+        version = ds[agglev].attrs['region_table']
+
+    table = load_region_table(agglev, version, table_dir=table_dir)
+
+    ds = ds.copy()
+    ds.coords[agglev] = table.values[ds[agglev].values]
 
     return ds
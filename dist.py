@@ -9,6 +9,8 @@ import matplotlib.pyplot as plt
 import seaborn
 import impactlab_tools.utils.weighting
 
+from climate_toolbox import decode_regions
+
 input_version = '2.0'
 output_version = '2.3'
 quantile_run = True
@@ -34,6 +36,12 @@ WRITE_PATH = (
         '{{variable_descriptor}}_percentiles{{nat}}.csv')
         .format(input_version=input_version, output_dir=output_dir))
 
+# region tables written alongside the model outputs, used to decode outputs
+# written with region_codes=True
+REGION_TABLE_DIR = (
+    '/shares/gcp/outputs/impact_lab_website/web-v{input_version}/global/climate/regions'
+        .format(input_version=input_version))
+
 READ_PATH_SEASONAL = (
     ('/shares/gcp/outputs/impact_lab_website/web-v{input_version}/global/climate/' +
         '{{rcp_per}}/{{agglev}}/{{transformation}}/' +
@@ -152,6 +160,71 @@ def get_data(model, kwargs):
         print(fp)
         raise
 
+def region_table_version(datasets, agglev):
+    '''
+    Region table version shared by region-coded model outputs
+
+    Codes only identify the same region in files encoded against the same
+    region table, so all models must share one before they are concatenated
+    on their int32 region axes.
+
+    Parameters
+    ----------
+    datasets: list
+        model datasets as read
+
+    agglev: str
+        name of the region dimension
+
+    Returns
+    -------
+    str
+        the ``region_table`` attribute of the region coordinates, or None if
+        the outputs store region labels
+    '''
+
+    versions = set([ds[agglev].attrs.get('region_table') for ds in datasets])
+
+    if len(versions) > 1:
+        raise ValueError(
+            'model outputs use different {} region tables: {}'.format(
+                agglev, ', '.join(map(str, versions))))
+
+    return versions.pop()
+
+
+def decode_region_codes(ds, agglev, version):
+    '''
+    Restores region labels on data read from region-coded output files
+
+    Model outputs written with ``region_codes=True`` store the region axis
+    as int32 codes, so concatenating models aligns on integers. The labels
+    are looked up once, on the reduced result.
+
+    Parameters
+    ----------
+    ds: Xarray Dataset or DataArray
+        data with an ``agglev`` dimension
+
+    agglev: str
+        name of the region dimension
+
+    version: str
+        region table version of the inputs, from
+        :py:func:`region_table_version`. None if they store region labels.
+
+    Returns
+    -------
+    Xarray Dataset or DataArray
+    '''
+
+    if version is None:
+        return ds
+
+    return decode_regions(
+        ds, agglev, version=version, table_dir=REGION_TABLE_DIR)
+
+
 def test_loader():
     ds = get_data(
         'pattern29',
@@ -186,10 +259,14 @@ def sample_data(rcp, outfile):
         for model in models:
             all_of_them.append(get_data(model, kwargs))
 
+        version = region_table_version(all_of_them, 'ISO')
+
         ds = xr.concat(
             [xr.Dataset({'tasmin-under-32F': var[var.data_vars.keys()[0]]}) for var in all_of_them],
             dim=pd.Index(models, name='model'))
 
+        ds = decode_region_codes(ds, 'ISO', version)
+
         for j, ISO in enumerate(countries):
 
             ax = fig.add_subplot(len(countries), 4, j*len(rcp_and_period) + i + 1, sharex=ax, sharey=ax)
@@ -284,10 +361,14 @@ def sample_quantiles(rcp, outfile):
         for model in models:
             all_of_them.append(get_data(model, kwargs))
 
+        version = region_table_version(all_of_them, 'ISO')
+
         ds = get_quantiles(xr.concat(
             [var.rename({var.data_vars.keys()[0]: variable}) for var in all_of_them],
             dim=pd.Index(models, name='model'))[variable], rcp)
 
+        ds = decode_region_codes(ds, 'ISO', version)
+
         for j, ISO in enumerate(countries):
 
             ax = fig.add_subplot(len(countries), 4, j*len(rcp_and_period) + i + 1, sharex=ax, sharey=ax)
@@ -334,12 +415,16 @@ def prep_ds(
 
     # print([d.dims for d in model_data])
 
+    version = region_table_version(model_data, agglev)
+
     concatted = xr.concat(
         model_data,
         dim=pd.Index(models, name='model'))
 
     ds = get_quantiles(concatted[variable], rcp)
 
+    ds = decode_region_codes(ds, agglev, version)
+
     return ds, len(all_of_them)
 
 
@@ -0,0 +1,124 @@
+'''
+Filled, longitude-standardized BCSD daily data
+
+Raw NASA BCSD daily files are filled (NA values interpolated) and rescaled to
+longitudes in -180:180 once, and written to a memory-mappable store that
+load_bcsd reads instead of the raw file.
+'''
+
+import os
+import pprint
+import logging
+
+import utils
+from climate_toolbox import (
+    has_bcsd_store,
+    write_bcsd_store)
+
+FORMAT = '%(asctime)-15s %(message)s'
+logging.basicConfig(format=FORMAT)
+
+logger = logging.getLogger('uploader')
+logger.setLevel('DEBUG')
+
+__author__ = 'Michael Delgado'
+__contact__ = 'mdelgado@rhg.com'
+__version__ = '0.1.0'
+
+
+BCSD_orig_files = (
+    '/global/scratch/jiacany/nasa_bcsd/raw_data/{rcp}/{model}/{variable}/' +
+    '{variable}_day_BCSD_{rcp}_r1i1p1_{model}_{{year}}.nc')
+
+JOBS = [
+    dict(variable='tas'),
+    dict(variable='tasmax'),
+    dict(variable='tasmin')]
+
+PERIODS = [
+    dict(rcp='historical', pername='1986', years=list(range(1986, 2006))),
+    dict(rcp='rcp85', pername='2020', years=list(range(2020, 2040))),
+    dict(rcp='rcp85', pername='2040', years=list(range(2040, 2060))),
+    dict(rcp='rcp85', pername='2060', years=list(range(2060, 2080))),
+    dict(rcp='rcp85', pername='2080', years=list(range(2080, 2100))),
+    dict(rcp='rcp45', pername='2020', years=list(range(2020, 2040))),
+    dict(rcp='rcp45', pername='2040', years=list(range(2040, 2060))),
+    dict(rcp='rcp45', pername='2060', years=list(range(2060, 2080))),
+    dict(rcp='rcp45', pername='2080', years=list(range(2080, 2100)))
+    ]
+
+MODELS = list(map(lambda x: dict(model=x), [
+    'ACCESS1-0',
+    'bcc-csm1-1',
+    'BNU-ESM',
+    'CanESM2',
+    'CCSM4',
+    'CESM1-BGC',
+    'CNRM-CM5',
+    'CSIRO-Mk3-6-0',
+    'GFDL-CM3',
+    'GFDL-ESM2G',
+    'GFDL-ESM2M',
+    'IPSL-CM5A-LR',
+    'IPSL-CM5A-MR',
+    'MIROC-ESM-CHEM',
+    'MIROC-ESM',
+    'MIROC5',
+    'MPI-ESM-LR',
+    'MPI-ESM-MR',
+    'MRI-CGCM3',
+    'inmcm4',
+    'NorESM1-M'
+    ]))
+
+
+JOB_SPEC = [JOBS, PERIODS, MODELS]
+
+def run_job(metadata, variable, rcp, pername, years, model):
+
+    logger.debug('Beginning job\nkwargs:\t{}'.format(
+        pprint.pformat(metadata, indent=2)))
+
+    read_file = BCSD_orig_files.format(**metadata)
+
+    for y in years:
+        fp = read_file.format(year=y)
+
+        # do not duplicate
+        if has_bcsd_store(fp, variable):
+            continue
+
+        logger.debug('year {} - preprocessing file "{}"'.format(y, fp))
+        store = write_bcsd_store(
+            fp, variable, workers=utils.get_num_workers())
+
+        logger.debug('year {} - wrote store "{}"'.format(y, store))
+
+    logger.debug('job done')
+
+
+def onfinish():
+    logger.info('all done!')
+
+
+def job_test_filepaths(metadata, variable, rcp, pername, years, model):
+
+    # make sure the input data exist
+
+    read_file = BCSD_orig_files.format(**metadata)
+
+    for y in years:
+        fp = read_file.format(year=y)
+        assert os.path.isfile(fp), "No such file: '{}'".format(fp)
+
+
+main = utils.slurm_runner(
+    filepath=__file__,
+    job_spec=JOB_SPEC,
+    run_job=run_job,
+    test_job=job_test_filepaths,
+    onfinish=onfinish)
+
+
+if __name__ == '__main__':
+    main()
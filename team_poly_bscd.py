@@ -204,13 +204,20 @@ def run_job(
         model,
         agglev,
         aggwt,
-        weights=None):
+        weights=None,
+        skipna=False,
+        regions=None,
+        region_codes=False,
+        partial=False,
+        chunks=None):
 
     import xarray as xr
     import metacsv
 
     from climate_toolbox import (
         load_bcsd,
+        has_bcsd_store,
+        prepare_aggregation,
         weighted_aggregate_grid_to_regions)
 
     # Add to job metadata
@@ -219,25 +226,43 @@ def run_job(
     file_dependencies = {}
 
     read_file = BCSD_orig_files.format(**metadata)
-    write_file = WRITE_PATH.format(**metadata)
+    write_file = utils.output_path(
+        WRITE_PATH.format(**metadata),
+        regions=regions,
+        skipna=(skipna and not agglev.startswith('grid')),
+        partial=(partial and not agglev.startswith('grid')))
 
     # do not duplicate
     if os.path.isfile(write_file):
         return
 
+    weights, fill, window = prepare_aggregation(
+        agglev, weights=weights, skipna=skipna, regions=regions)
+
     # Get transformed data
     fp = read_file.format(year=year)
 
-    with xr.open_dataset(fp) as ds:
-        ds.load()
+    logger.debug('year {} - attempting to read file "{}"'.format(year, fp))
+
+    if not (fill and has_bcsd_store(fp, source_variable)):
+        fp = utils.staged(fp)
+
+    ds = load_bcsd(
+        fp,
+        source_variable,
+        broadcast_dims=('time',),
+        workers=utils.get_num_workers(),
+        weights=weights,
+        fill=fill,
+        standardize_lon=agglev.startswith('grid'),
+        chunks=chunks,
+        window=window,
+        variables=[source_variable])
 
     file_dependencies[os.path.splitext(os.path.basename(fp))[0]] = (
         str(ds.attrs.get('version', '1.0')))
 
-    logger.debug('year {} - attempting to read file "{}"'.format(year, fp))
-    ds = (
-            load_bcsd(ds, source_variable, broadcast_dims=('time',))
-            .pipe(transformation))
+    ds = ds.pipe(transformation)
 
     varattrs = {var: dict(ds[var].attrs) for var in ds.data_vars.keys()}
 
@@ -245,34 +270,42 @@ def run_job(
     if not agglev.startswith('grid'):
         logger.debug('aggregating to "{}" using "{}"'.format(agglev, aggwt))
         ds = weighted_aggregate_grid_to_regions(
-                ds, variable, aggwt, agglev, weights=weights)
+                ds, variable, aggwt, agglev, weights=weights, skipna=skipna,
+                regions=regions, partial=partial)
 
-    # Update netCDF metadata
-    ds.attrs.update(**{
-        k: str(v) for k, v in metadata.items() if k in INCLUDED_METADATA})
-    ds.attrs.update(ADDITIONAL_METADATA)
+        # partial aggregates hold the weighted sum of the variable and the
+        # total weight it is to be divided by
+        if partial:
+            varattrs = {
+                '{}_wsum'.format(variable): varattrs[variable],
+                '{}_wtotal'.format(variable): {'aggwt': aggwt}}
 
-    # Write output
-    if not os.path.isdir(os.path.dirname(write_file)):
-        logger.debug(
-            'attempting to create_directory "{}"'
-            .format(os.path.dirname(write_file)))
+    # Update netCDF metadata
+    attrs = {
+        k: str(v) for k, v in metadata.items() if k in INCLUDED_METADATA}
+    attrs.update(ADDITIONAL_METADATA)
 
-        os.makedirs(os.path.dirname(write_file))
+    for var, vattrs in varattrs.items():
+        ds[var].attrs.update(vattrs)
 
     logger.debug('attempting to write to file "{}"'.format(write_file))
 
-    attrs = dict(ds.attrs)
-    attrs['file_dependencies'] = file_dependencies
-
-    for var, vattrs in varattrs.items():
-        ds[var].attrs.update(vattrs)
+    utils.write_outputs(
+        {agglev: ds},
+        {agglev: write_file},
+        attrs=attrs,
+        skipna=skipna,
+        region_codes=region_codes,
+        table_dir=utils.PROJECTION_REGION_TABLE_DIR)
 
-    ds.to_netcdf(write_file)
+    header = dict(ds.attrs)
+    header.update(attrs)
+    header['skipna'] = int(skipna and not agglev.startswith('grid'))
+    header['file_dependencies'] = file_dependencies
 
     metacsv.to_header(
         write_file.replace('.nc', '.fgh'),
-        attrs=dict(attrs),
+        attrs=header,
         variables=varattrs)
 
     logger.debug('job done')
@@ -282,11 +315,30 @@ def onfinish():
     logger.info('all done!')
 
 
+def job_inputs(metadata, **kwargs):
+    '''
+    BCSD file read by a job, staged to node-local disk before it runs
+
+    Files that have been preprocessed (see ``preprocess_bcsd.py``) are not
+    staged.
+    '''
+
+    from climate_toolbox import has_bcsd_store
+
+    fp = BCSD_orig_files.format(**metadata)
+
+    if has_bcsd_store(fp, metadata['source_variable']):
+        return []
+
+    return [fp]
+
+
 main = utils.slurm_runner(
     filepath=__file__,
     job_spec=JOB_SPEC,
     run_job=run_job,
-    onfinish=onfinish)
+    onfinish=onfinish,
+    inputs=job_inputs)
 
 
 if __name__ == '__main__':
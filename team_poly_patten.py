@@ -18,6 +18,7 @@ import utils
 from climate_toolbox import (
     load_bcsd,
     load_baseline,
+    prepare_aggregation,
     weighted_aggregate_grid_to_regions)
 
 FORMAT = '%(asctime)-15s %(message)s'
@@ -196,7 +197,12 @@ def run_job(
         baseline_model,
         agglev,
         aggwt,
-        weights=None):
+        weights=None,
+        skipna=False,
+        regions=None,
+        region_codes=False,
+        partial=False,
+        prefetch=1):
 
     logger.debug('Beginning job\nkwargs:\t{}'.format(
         pprint.pformat(metadata, indent=2)))
@@ -207,11 +213,18 @@ def run_job(
 
     baseline_file = BASELINE_FILE.format(**metadata)
     pattern_file = BCSD_pattern_files.format(**metadata)
-    write_file = WRITE_PATH.format(**metadata)
+    write_file = utils.output_path(
+        WRITE_PATH.format(**metadata),
+        regions=regions,
+        skipna=(skipna and not agglev.startswith('grid')),
+        partial=(partial and not agglev.startswith('grid')))
     
     # do not duplicate
     if os.path.isfile(write_file):
         return
+
+    weights, fill, window = prepare_aggregation(
+        agglev, weights=weights, skipna=skipna, regions=regions)
     
     # Get transformed data
     total = None
@@ -220,17 +233,34 @@ def run_job(
     for season in SEASONS:
         basef = baseline_file.format(season=season)
         logger.debug('attempting to load baseline file: {}'.format(basef))
-        seasonal_baselines[season] = load_baseline(basef, source_variable)
+        seasonal_baselines[season] = load_baseline(
+            utils.staged(basef),
+            source_variable,
+            weights=weights,
+            fill=fill,
+            window=window)
 
     season_month_start = {'DJF': 12, 'MAM': 3, 'JJA': 6, 'SON': 9}
 
+    def load_pattern(season):
+        pattf = pattern_file.format(year=year, season=season)
+        logger.debug('attempting to load pattern file: {}'.format(pattf))
+        return load_bcsd(
+            utils.staged(pattf),
+            source_variable,
+            broadcast_dims=('day',),
+            workers=utils.get_num_workers(),
+            weights=weights,
+            fill=fill,
+            window=window)
+
+    # read the next seasons in the background while this one computes
+    patterns = utils.prefetch(load_pattern, SEASONS, depth=prefetch)
+
     seasonal = []
 
     for s, season in enumerate(SEASONS):
-
-        pattf = pattern_file.format(year=year, season=season)
-        logger.debug('attempting to load pattern file: {}'.format(pattf))
-        patt = load_bcsd(pattf, source_variable, broadcast_dims=('day',))
+        patt = next(patterns)
 
         logger.debug(
             '{} {} {} - reindexing coords day --> time'.format(
@@ -266,31 +296,48 @@ def run_job(
     logger.debug('{} reshaping to regions'.format(model))
     if not agglev.startswith('grid'):
         ds = weighted_aggregate_grid_to_regions(
-                ds, variable, aggwt, agglev, weights=weights)
+                ds, variable, aggwt, agglev, weights=weights, skipna=skipna,
+                regions=regions, partial=partial)
 
-    # Update netCDF metadata
-    logger.debug('{} udpate metadata'.format(model))
-    ds.attrs.update(**{k: str(v)
-        for k, v in metadata.items() if k in INCLUDED_METADATA})
-    ds.attrs.update(ADDITIONAL_METADATA)
-
-    # Write output
     logger.debug('attempting to write to file: {}'.format(write_file))
-    if not os.path.isdir(os.path.dirname(write_file)):
-        os.makedirs(os.path.dirname(write_file))
 
-    ds.to_netcdf(write_file)
+    attrs = {
+        k: str(v) for k, v in metadata.items() if k in INCLUDED_METADATA}
+    attrs.update(ADDITIONAL_METADATA)
+
+    utils.write_outputs(
+        {agglev: ds},
+        {agglev: write_file},
+        attrs=attrs,
+        skipna=skipna,
+        region_codes=region_codes,
+        table_dir=utils.WEB_REGION_TABLE_DIR)
 
 
 def onfinish():
     print('all done!')
 
 
+def job_inputs(metadata, **kwargs):
+    '''
+    Baseline and pattern files read by a job, staged to node-local disk
+    before it runs
+    '''
+
+    baseline_file = BASELINE_FILE.format(**metadata)
+    pattern_file = BCSD_pattern_files.format(**metadata)
+
+    return (
+        [baseline_file.format(season=season) for season in SEASONS] +
+        [pattern_file.format(season=season) for season in SEASONS])
+
+
 main = utils.slurm_runner(
     filepath=__file__,
     job_spec=JOB_SPEC,
     run_job=run_job,
-    onfinish=onfinish)
+    onfinish=onfinish,
+    inputs=job_inputs)
 
 
 if __name__ == '__main__':
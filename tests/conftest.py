@@ -0,0 +1,90 @@
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+
+# keep the fill operators, stores and region tables built by the tests out
+# of the user's cache
+os.environ.setdefault('CLIMATE_TOOLBOX_CACHE', tempfile.mkdtemp())
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_grid(n_time=4, ny=80, nx=160, gridsize=0.25, seed=0):
+    '''
+    Smooth field with rectangular NaN holes on a 0:360 grid
+    '''
+
+    rng = np.random.RandomState(seed)
+
+    lat = -9.875 + gridsize * np.arange(ny)
+    lon = 170.125 + gridsize * np.arange(nx)
+    lons, lats = np.meshgrid(lon, lat)
+
+    data = np.empty((n_time, ny, nx))
+
+    for t in range(n_time):
+        mask = np.zeros((ny, nx), dtype=bool)
+
+        for _ in range(30):
+            y, x = rng.randint(21, ny - 26), rng.randint(0, nx - 9)
+            mask[y:y + rng.randint(1, 6), x:x + rng.randint(1, 9)] = True
+
+        data[t] = (
+            np.sin(lons / 7.) + np.cos(lats / 5.) + t
+            + 0.1 * rng.randn(ny, nx))
+
+        data[t][mask] = np.nan
+
+    return xr.Dataset(
+        {'tas': (('time', 'lat', 'lon'), data)},
+        coords={'time': np.arange(n_time), 'lat': lat, 'lon': lon})
+
+
+def make_weights(ds, n_segments=3000, n_regions=60, seed=1):
+    '''
+    Random segment weights on the cells of ``ds``, with hierid and ISO
+    region levels
+    '''
+
+    rng = np.random.RandomState(seed)
+
+    lat = ds.lat.values
+    lon = ds.lon.values
+
+    iy = rng.randint(0, len(lat), n_segments)
+    ix = rng.randint(0, len(lon), n_segments)
+
+    iso = np.array(['AAA', 'BBB', 'CCC'])[rng.randint(0, 3, n_regions)]
+    hierid = np.array([
+        '{}.{}.{}'.format(iso[i], i % 4, i) for i in range(n_regions)])
+
+    region = rng.randint(0, n_regions, n_segments)
+
+    weights = pd.DataFrame({
+        'lat': lat[iy],
+        'lon': np.where(lon[ix] > 180, lon[ix] - 360, lon[ix]),
+        'hierid': hierid[region],
+        'ISO': iso[region],
+        'areawt': rng.rand(n_segments),
+        'popwt': np.where(
+            rng.rand(n_segments) < 0.2, np.nan, rng.rand(n_segments))})
+
+    weights.index.name = 'reshape_index'
+
+    return weights
+
+
+@pytest.fixture
+def grid():
+    return make_grid()
+
+
+@pytest.fixture
+def weights(grid):
+    return make_weights(grid)
@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+
+ct = pytest.importorskip('climate_toolbox')
+
+
+def _groupby_aggregate(ds, aggwt, agglev, weights, skipna=False):
+    '''
+    Weighted regional means computed with a pandas groupby over the
+    segments, as the aggregation was originally written
+    '''
+
+    values = ds.tas.sel(
+        lat=xr.DataArray(weights.lat.values, dims='reshape_index'),
+        lon=xr.DataArray(weights.lon.values % 360, dims='reshape_index'))
+
+    values = values.transpose('reshape_index', 'time').values
+
+    wt = weights[aggwt].where(weights[aggwt] > 0).fillna(weights['areawt'])
+    wt = np.repeat(wt.values[:, np.newaxis], values.shape[1], axis=1)
+
+    if skipna:
+        wt[np.isnan(values)] = 0
+        values = np.where(np.isnan(values), 0, values)
+
+    labels = weights[agglev].values
+
+    total = pd.DataFrame(values * wt).groupby(labels).sum()
+    norm = pd.DataFrame(wt).groupby(labels).sum()
+
+    return (total / norm.where(norm > 0)).values, total.index.values
+
+
+@pytest.mark.parametrize('engine', ['sparse', 'reduceat'])
+@pytest.mark.parametrize('aggwt', ['areawt', 'popwt'])
+@pytest.mark.parametrize('skipna', [False, True])
+def test_aggregation_matches_groupby(grid, weights, engine, aggwt, skipna):
+
+    # aggregation without skipna expects filled data
+    if not skipna:
+        grid = grid.fillna(0.5)
+
+    for agglev in ('hierid', 'ISO'):
+        expected, regions = _groupby_aggregate(
+            grid, aggwt, agglev, weights, skipna=skipna)
+
+        res = ct.weighted_aggregate_grid_to_regions(
+            grid,
+            'tas',
+            aggwt,
+            agglev,
+            weights=weights,
+            skipna=skipna,
+            engine=engine,
+            cache_dir=None)
+
+        res = res.tas.sel(**{agglev: regions}).transpose(agglev, 'time')
+
+        np.testing.assert_allclose(res.values, expected, rtol=1e-12)
+
+
+@pytest.mark.parametrize('aggwt', ['areawt', 'popwt'])
+@pytest.mark.parametrize('skipna', [False, True])
+def test_rollup_matches_direct_aggregation(grid, weights, aggwt, skipna):
+    levels = ['hierid', 'hierid:2', 'ISO']
+
+    # the coarser levels are rolled up from the hierid aggregates
+    rolled = ct.weighted_aggregate_grid_to_regions(
+        grid,
+        'tas',
+        aggwt,
+        levels,
+        weights=weights,
+        skipna=skipna,
+        cache_dir=None)
+
+    for agglev in levels:
+        direct = ct.weighted_aggregate_grid_to_regions(
+            grid,
+            'tas',
+            aggwt,
+            agglev,
+            weights=weights,
+            skipna=skipna,
+            engine='reduceat',
+            cache_dir=None)
+
+        res = rolled[agglev].tas.sel(**{agglev: direct[agglev].values})
+
+        np.testing.assert_allclose(
+            res.transpose(*direct.tas.dims).values,
+            direct.tas.values,
+            rtol=1e-12)
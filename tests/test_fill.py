@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+ct = pytest.importorskip('climate_toolbox')
+
+
+@pytest.fixture(autouse=True)
+def fill_operators(monkeypatch):
+    # build every operator afresh rather than reuse another test's
+    monkeypatch.setattr(ct, '_FILL_OPERATORS', {})
+
+
+def _fill(ds, **kwargs):
+    filled = ds.copy(deep=True)
+    ct._fill_holes_xr(filled, 'tas', cache_dir=None, **kwargs)
+
+    return filled.tas.values
+
+
+def test_sparse_fill_matches_griddata(grid):
+    expected = _fill(grid, engine='griddata')
+    filled = _fill(grid, engine='sparse')
+
+    assert np.isnan(filled).sum() < np.isnan(grid.tas.values).sum()
+    np.testing.assert_array_equal(np.isnan(filled), np.isnan(expected))
+    np.testing.assert_allclose(filled, expected, rtol=0, atol=1e-10)
+
+
+def test_sparse_fill_matches_griddata_around_required_cells(grid, weights):
+    required = ct._required_cells(
+        grid.lat.values, grid.lon.values, weights)
+
+    expected = _fill(grid, engine='griddata', required=required)
+    filled = _fill(grid, engine='sparse', required=required)
+
+    np.testing.assert_allclose(
+        filled[:, required], expected[:, required], rtol=0, atol=1e-10)
+
+
+def test_sparse_fill_is_independent_of_workers(grid):
+    # one mask, so the patches are triangulated across the workers
+    ds = grid.isel(time=[0, 0])
+
+    parallel = _fill(ds, engine='sparse', workers=2)
+    ct._FILL_OPERATORS.clear()
+
+    np.testing.assert_array_equal(parallel, _fill(ds, engine='sparse'))
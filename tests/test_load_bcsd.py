@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+ct = pytest.importorskip('climate_toolbox')
+pytest.importorskip('dask')
+
+
+@pytest.mark.parametrize('fill', [True, False])
+def test_chunked_load_matches_in_memory(grid, weights, tmp_path, fill):
+    fp = str(tmp_path / 'tas.nc')
+    grid.to_netcdf(fp)
+
+    kwargs = dict(weights=weights, fill=fill, store_dir=None)
+
+    loaded = ct.load_bcsd(fp, 'tas', **kwargs)
+    chunked = ct.load_bcsd(fp, 'tas', chunks={'time': 1}, **kwargs)
+
+    assert chunked.tas.chunks is not None
+    np.testing.assert_array_equal(chunked.tas.values, loaded.tas.values)
+
+    for aggwt in ('areawt', 'popwt'):
+        expected = ct.weighted_aggregate_grid_to_regions(
+            loaded,
+            'tas',
+            aggwt,
+            ['hierid', 'ISO'],
+            weights=weights,
+            skipna=not fill,
+            cache_dir=None)
+
+        res = ct.weighted_aggregate_grid_to_regions(
+            chunked,
+            'tas',
+            aggwt,
+            ['hierid', 'ISO'],
+            weights=weights,
+            skipna=not fill,
+            cache_dir=None)
+
+        for agglev in ('hierid', 'ISO'):
+            assert res[agglev].identical(expected[agglev])
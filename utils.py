@@ -1,9 +1,51 @@
 import os
+import sys
+import six
+import time
 import click
+import shutil
 import itertools
 import functools
+import threading
 import subprocess
+import contextlib
 import re
+import hashlib
+
+from six.moves import queue
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Node-local directory in which job inputs are staged. Staging is opt-in:
+# it is disabled unless this is set.
+STAGING_DIR = os.environ.get('CLIMATE_TOOLBOX_STAGING') or None
+
+# Staged files are evicted, least recently used first, beyond this size
+STAGING_MAX_BYTES = int(
+    float(os.environ.get('CLIMATE_TOOLBOX_STAGING_BYTES', 200e9)))
+
+# ... or beyond this fraction of the staging filesystem's free space plus
+# the space staged files already use, so a shared node's disk never fills up
+STAGING_MAX_FRACTION = float(
+    os.environ.get('CLIMATE_TOOLBOX_STAGING_FRACTION', 0.25))
+
+# Staged files used within this many seconds are never evicted, so a file
+# returned by stage() is not removed before the caller opens it
+_EVICTION_GRACE_SECONDS = 600
+
+# Local copies of the current job's declared inputs, never evicted by this
+# process while the job runs
+_STAGED_INPUTS = set()
+
+# Region tables of outputs written with region_codes=True, shared by all
+# readers of the outputs under each output root
+WEB_REGION_TABLE_DIR = '/global/scratch/mdelgado/web/gcp/climate/regions'
+PROJECTION_REGION_TABLE_DIR = (
+    '/global/scratch/mdelgado/projection/gcp/climate/regions')
 
 SLURM_SCRIPT = '''
 #!/bin/bash
@@ -33,6 +75,9 @@ SLURM_SCRIPT = '''
 {dependencies}
 {output}
 
+## Share fill operators and other climate_toolbox caches across jobs
+export CLIMATE_TOOLBOX_CACHE=${{CLIMATE_TOOLBOX_CACHE:-/global/scratch/$USER/.climate_toolbox}}
+
 ## Run command
 python {filepath} {flags}
 '''.strip()
@@ -150,6 +195,481 @@ def run_slurm(
     return run_id
 
 
+def get_num_workers():
+    '''
+    Number of CPUs allocated to the current job on this node
+
+    Falls back to 1 outside of slurm.
+    '''
+    return int(os.environ.get('SLURM_CPUS_ON_NODE', 1))
+
+
+def output_path(fp, regions=None, partial=False, skipna=False):
+    '''
+    Output path of a job writing a subset of regions, partial aggregates
+    or aggregates of unfilled data
+
+    These variants must not be written to the path of the full product,
+    or a later full run would find them and skip. A subset is identified
+    by a digest of its sorted labels, aggregates computed with
+    ``skipna=True`` by a ``_skipna`` suffix and partial aggregates by a
+    ``_partial`` suffix, appended to the file name.
+
+    Parameters
+    ----------
+    fp : str
+        output path of the full product
+
+    regions : list, optional
+        region labels of the subset (default None, all regions)
+
+    partial : bool, optional
+        the output holds weighted sums and weight totals rather than
+        weighted means (default False)
+
+    skipna : bool, optional
+        the output was aggregated with ``skipna=True`` from unfilled data
+        (default False)
+
+    Returns
+    -------
+    str
+    '''
+
+    root, ext = os.path.splitext(fp)
+
+    if regions is not None:
+        digest = hashlib.sha1(
+            '\n'.join(sorted(set(map(str, regions)))).encode('utf-8'))
+
+        root = '{}_regions-{}'.format(root, digest.hexdigest()[:12])
+
+    if skipna:
+        root = '{}_skipna'.format(root)
+
+    if partial:
+        root = '{}_partial'.format(root)
+
+    return root + ext
+
+
+def write_outputs(
+        outputs,
+        write_files,
+        attrs=None,
+        skipna=False,
+        region_codes=False,
+        table_dir=WEB_REGION_TABLE_DIR):
+    '''
+    Writes a job's outputs, one file per regional level
+
+    Parameters
+    ----------
+    outputs : dict
+        datasets by regional level. Levels starting with ``'grid'`` are
+        gridded outputs
+
+    write_files : dict
+        output paths by regional level (see :py:func:`output_path`)
+
+    attrs : dict, optional
+        netCDF attributes of every output. ``agglev``, if present, is set
+        to each output's level (default None)
+
+    skipna : bool, optional
+        the outputs were aggregated with ``skipna=True``, recorded in the
+        ``skipna`` attribute of aggregated outputs (default False)
+
+    region_codes : bool, optional
+        write the region axes of aggregated outputs as int32 codes into the
+        region table of their level in ``table_dir`` (default False)
+
+    table_dir : str, optional
+        directory of the region tables shared by all readers of the outputs
+        (default ``WEB_REGION_TABLE_DIR``)
+    '''
+
+    from climate_toolbox import encode_regions, get_region_table
+
+    for level, ds in outputs.items():
+        write_file = write_files[level]
+        gridded = level.startswith('grid')
+
+        if region_codes and not gridded:
+            table = get_region_table(level, table_dir=table_dir)
+            ds = encode_regions(ds, level, table)
+
+        if attrs is not None:
+            ds.attrs.update(attrs)
+
+            if 'agglev' in attrs:
+                ds.attrs['agglev'] = level
+
+        ds.attrs['skipna'] = int(skipna and not gridded)
+
+        if not os.path.isdir(os.path.dirname(write_file)):
+            os.makedirs(os.path.dirname(write_file))
+
+        ds.to_netcdf(write_file)
+
+
+def prefetch(func, items, depth=1):
+    '''
+    Iterates over ``func(item)`` for each item, computing the results ahead
+    in a background thread
+
+    Use this to read and prepare the next input files while the current one
+    is being transformed. File reads and numpy operations release the GIL,
+    so the two overlap.
+
+    Parameters
+    ----------
+    func : function
+        called on each item, e.g. a function that loads one year of data
+
+    items : iterable
+        arguments to ``func``
+
+    depth : int, optional
+        number of results to compute ahead of the one being used. At most
+        ``depth`` + 2 results are held in memory at once: ``depth`` waiting,
+        one being computed and one being used. Set to 0 to compute each
+        result when it is needed (default 1)
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> list(prefetch(lambda x: x**2, range(5), depth=2))
+        [0, 1, 4, 9, 16]
+
+    '''
+
+    items = list(items)
+
+    if depth < 1:
+        for item in items:
+            yield func(item)
+
+        return
+
+    results = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def worker():
+        for item in items:
+            try:
+                result = (True, func(item))
+            except Exception:
+                result = (False, sys.exc_info())
+
+            # wait for room in the queue unless the consumer has gone away
+            while not stop.is_set():
+                try:
+                    results.put(result, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+            if stop.is_set() or (not result[0]):
+                return
+
+    thread = threading.Thread(target=worker)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        for _ in items:
+            success, result = results.get()
+
+            if not success:
+                six.reraise(*result)
+
+            yield result
+
+    finally:
+        stop.set()
+
+
+@contextlib.contextmanager
+def _file_lock(path, blocking=True):
+    '''
+    Holds an exclusive lock on ``path + '.lock'``, shared across processes
+
+    Yields False without waiting if ``blocking`` is False and the lock is
+    held elsewhere. Lock files may be removed by their holder (see
+    :py:func:`_evict_staged_files`), so a lock taken on a file that has
+    since been unlinked is retried on the current one.
+    '''
+
+    lock = path + '.lock'
+
+    flags = fcntl.LOCK_EX
+
+    if not blocking:
+        flags |= fcntl.LOCK_NB
+
+    while True:
+        f = open(lock, 'a')
+
+        try:
+            fcntl.flock(f, flags)
+        except (IOError, OSError):
+            f.close()
+            yield False
+            return
+
+        try:
+            current = os.stat(lock).st_ino == os.fstat(f.fileno()).st_ino
+        except OSError:
+            current = False
+
+        if current:
+            break
+
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+    try:
+        yield True
+    finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+
+def _staged_path(fp, staging_dir):
+    return os.path.join(staging_dir, os.path.abspath(fp).lstrip(os.sep))
+
+
+def _is_staged(local, source):
+    if not os.path.isfile(local):
+        return False
+
+    stat = os.stat(local)
+
+    return (
+        (stat.st_size == source.st_size)
+        and (int(stat.st_mtime) == int(source.st_mtime)))
+
+
+def stage(fp, staging_dir=None, max_bytes=None, keep=None):
+    '''
+    Copies a file to node-local disk and returns the path of the local copy
+
+    Concurrent requests for the same file (e.g. from array tasks on the
+    same node) are serialized with a file lock, so the file is copied once
+    and the other requests reuse the copy. A copy is reused as long as its
+    size and modification time match the source.
+
+    Parameters
+    ----------
+    fp : str
+        path of the file to stage
+
+    staging_dir : str, optional
+        node-local directory to copy files to (default ``STAGING_DIR``, set
+        by the ``CLIMATE_TOOLBOX_STAGING`` environment variable. Staging is
+        disabled if it is not set)
+
+    max_bytes : int, optional
+        size of the staging directory beyond which least recently used
+        files are removed. The size is also capped at
+        ``STAGING_MAX_FRACTION`` of the free and staged space on the
+        staging filesystem (default ``STAGING_MAX_BYTES``)
+
+    keep : list, optional
+        local paths that must not be evicted, in addition to the inputs
+        declared with :py:func:`stage_files`
+
+    Returns
+    -------
+    str
+        path of the local copy, or ``fp`` if staging is disabled, not
+        supported on this platform, ``fp`` is not a file, the file does not
+        fit in the staging filesystem or the copy failed
+    '''
+
+    if staging_dir is None:
+        staging_dir = STAGING_DIR
+
+    if max_bytes is None:
+        max_bytes = STAGING_MAX_BYTES
+
+    if (staging_dir is None) or (fcntl is None) or (not os.path.isfile(fp)):
+        return fp
+
+    local = _staged_path(fp, staging_dir)
+    source = os.stat(fp)
+
+    if not os.path.isdir(os.path.dirname(local)):
+        try:
+            os.makedirs(os.path.dirname(local))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(local)):
+                raise
+
+    with _file_lock(local):
+        if not _is_staged(local, source):
+
+            # leave files that would crowd the staging filesystem in place
+            free = _free_bytes(os.path.dirname(local))
+
+            if source.st_size > STAGING_MAX_FRACTION * free:
+                return fp
+
+            tmp = local + '.tmp'
+
+            try:
+                shutil.copyfile(fp, tmp)
+                os.utime(tmp, (time.time(), source.st_mtime))
+                os.rename(tmp, local)
+
+            except (IOError, OSError):
+                # read from the source rather than fail the job
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+                return fp
+
+        # the access time records the last use for eviction
+        os.utime(local, (time.time(), source.st_mtime))
+
+    _evict_staged_files(
+        staging_dir,
+        max_bytes,
+        keep=set([local]) | _STAGED_INPUTS | set(keep or []))
+
+    return local
+
+
+def stage_files(paths, staging_dir=None, max_bytes=None):
+    '''
+    Stages a job's input files to node-local disk in bulk
+
+    The staged files replace the previous job's as the inputs that this
+    process never evicts, so they are not evicted to make room for each
+    other or for files staged later by :py:func:`staged`. Reads then go
+    through :py:func:`staged`, which returns the local copies.
+
+    Parameters
+    ----------
+    paths : list
+        input file paths
+
+    staging_dir : str, optional
+        node-local directory (default ``STAGING_DIR``)
+
+    max_bytes : int, optional
+        size cap of the staging directory (default ``STAGING_MAX_BYTES``)
+
+    Returns
+    -------
+    list
+        paths of the local copies
+    '''
+
+    if staging_dir is None:
+        staging_dir = STAGING_DIR
+
+    paths = list(paths)
+
+    if staging_dir is None:
+        return paths
+
+    _STAGED_INPUTS.clear()
+    _STAGED_INPUTS.update([_staged_path(fp, staging_dir) for fp in paths])
+
+    return [
+        stage(fp, staging_dir=staging_dir, max_bytes=max_bytes)
+        for fp in paths]
+
+
+def staged(fp):
+    '''
+    Path to read ``fp`` from: its node-local copy if staging is enabled
+
+    Files not yet staged (e.g. not declared as job inputs) are staged on
+    first use. If the local copy has been evicted by another process in the
+    meantime, the source path is returned.
+    '''
+
+    local = stage(fp)
+
+    if not os.path.isfile(local):
+        return fp
+
+    return local
+
+
+def _free_bytes(directory):
+    '''
+    Bytes available to this user on the filesystem holding ``directory``
+    '''
+
+    stat = os.statvfs(directory)
+
+    return stat.f_bavail * stat.f_frsize
+
+
+def _evict_staged_files(staging_dir, max_bytes, keep=None):
+    '''
+    Removes least recently used staged files until the directory fits in
+    ``max_bytes`` and in ``STAGING_MAX_FRACTION`` of the free and staged
+    space on its filesystem
+
+    Files in ``keep``, files used within ``_EVICTION_GRACE_SECONDS`` and
+    files locked by another process (being copied or checked) are skipped.
+    The lock files of evicted files are removed.
+    '''
+
+    keep = keep or set()
+
+    with _file_lock(os.path.join(staging_dir, '.staging')):
+        files = []
+
+        for root, dirs, names in os.walk(staging_dir):
+            for name in names:
+                if name.endswith(('.lock', '.tmp')):
+                    continue
+
+                path = os.path.join(root, name)
+
+                # skip files renamed into place or removed meanwhile
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+
+                files.append((stat.st_atime, stat.st_size, path))
+
+        total = sum([size for _, size, _ in files])
+
+        max_bytes = min(
+            max_bytes,
+            STAGING_MAX_FRACTION * (_free_bytes(staging_dir) + total))
+
+        recent = time.time() - _EVICTION_GRACE_SECONDS
+
+        for atime, size, path in sorted(files):
+            if total <= max_bytes:
+                break
+
+            if (path in keep) or (atime > recent):
+                continue
+
+            with _file_lock(path, blocking=False) as locked:
+                if not locked:
+                    continue
+
+                os.remove(path)
+                total -= size
+
+                # still holding the lock, so waiting processes retry on a
+                # new lock file
+                os.remove(path + '.lock')
+
+
 def get_job_by_index(job_spec, index):
     '''
     Examples
@@ -173,7 +693,15 @@ def get_job_by_index(job_spec, index):
         for i in range(len(job_spec))])
 
 
-def slurm_runner(filepath, job_spec, run_job, onfinish=None, test_job=None, additional_metadata=None):
+def slurm_runner(filepath, job_spec, run_job, onfinish=None, test_job=None, additional_metadata=None, inputs=None):
+    '''
+    Builds the command line interface of a job script
+
+    ``inputs``, if given, is called with the same arguments as ``run_job``
+    and returns the input files of the job. If ``CLIMATE_TOOLBOX_STAGING``
+    is set when the jobs are submitted, these are staged to that node-local
+    directory (see :py:func:`stage_files`) before the job runs.
+    '''
 
     @click.group()
     def slurm():
@@ -244,6 +772,9 @@ def slurm_runner(filepath, job_spec, run_job, onfinish=None, test_job=None, addi
 
         metadata.update({k: str(v) for k, v in job.items()})
 
+        if inputs is not None:
+            stage_files(inputs(metadata=metadata, **job))
+
         run_job(metadata=metadata, **job)
 
     @slurm.command()
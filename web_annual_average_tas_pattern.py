@@ -18,6 +18,7 @@ import utils
 from climate_toolbox import (
     load_bcsd,
     load_baseline,
+    prepare_aggregation,
     weighted_aggregate_grid_to_regions)
 
 FORMAT = '%(asctime)-15s %(message)s'
@@ -139,8 +140,7 @@ for spec in PERIODS:
 SEASONS = [{'seasons': [ 'DJF', 'MAM', 'JJA', 'SON']}]
 
 AGGREGATIONS = [
-    {'agglev': 'ISO', 'aggwt': 'areawt'},
-    {'agglev': 'hierid', 'aggwt': 'areawt'}]
+    {'agglev': ('hierid', 'ISO'), 'aggwt': 'areawt'}]
 
 
 JOB_SPEC = [JOBS, MODELS, SEASONS, AGGREGATIONS]
@@ -160,7 +160,12 @@ def run_job(
         unit,
         agglev,
         aggwt,
-        weights=None):
+        weights=None,
+        skipna=False,
+        regions=None,
+        region_codes=False,
+        partial=False,
+        prefetch=1):
 
     logger.debug('Beginning job\nkwargs:\t{}'.format(
         pprint.pformat(metadata, indent=2)))
@@ -171,11 +176,32 @@ def run_job(
 
     baseline_file = BASELINE_FILE.format(**metadata)
     pattern_file = BCSD_pattern_files.format(**metadata)
-    write_file = WRITE_PATH.format(**metadata)
-    
+
+    # regional levels listed together are aggregated in one pass
+    if isinstance(agglev, (list, tuple)):
+        agglevs = list(agglev)
+    else:
+        agglevs = [agglev]
+
+    write_files = {
+        level: utils.output_path(
+            WRITE_PATH.format(**dict(metadata, agglev=level)),
+            regions=regions,
+            skipna=(skipna and not level.startswith('grid')),
+            partial=(partial and not level.startswith('grid')))
+        for level in agglevs}
+
     # do not duplicate
-    if os.path.isfile(write_file):
+    agglevs = [
+        level for level in agglevs if not os.path.isfile(write_files[level])]
+
+    if len(agglevs) == 0:
         return
+
+    gridded = any([level.startswith('grid') for level in agglevs])
+
+    weights, fill, window = prepare_aggregation(
+        agglevs, weights=weights, skipna=skipna, regions=regions)
     
     del metadata['read_acct']
 
@@ -186,18 +212,42 @@ def run_job(
     for season in seasons:
         basef = baseline_file.format(season=season)
         logger.debug('attempting to load baseline file: {}'.format(basef))
-        seasonal_baselines[season] = load_baseline(basef, variable)
+        seasonal_baselines[season] = load_baseline(
+            utils.staged(basef),
+            variable,
+            weights=weights,
+            fill=fill,
+            window=window,
+            variables=[variable])
 
     season_month_start = {'DJF': 12, 'MAM': 3, 'JJA': 6, 'SON': 9}
 
+    def load_pattern(year_season):
+        year, season = year_season
+
+        pattf = pattern_file.format(year=year, season=season)
+        logger.debug('attempting to load pattern file: {}'.format(pattf))
+        return load_bcsd(
+            utils.staged(pattf),
+            variable,
+            broadcast_dims=('day',),
+            workers=utils.get_num_workers(),
+            weights=weights,
+            fill=fill,
+            window=window,
+            variables=[variable])
+
+    # read the next pattern files in the background while this one computes
+    patterns = utils.prefetch(
+        load_pattern,
+        [(year, season) for year in years for season in seasons],
+        depth=prefetch)
+
     for year in years:
         seasonal = []
 
         for s, season in enumerate(seasons):
-
-            pattf = pattern_file.format(year=year, season=season)
-            logger.debug('attempting to load pattern file: {}'.format(pattf))
-            patt = load_bcsd(pattf, variable, broadcast_dims=('day',))
+            patt = next(patterns)
 
             logger.debug(
                 '{} {} {} - reindexing coords day --> time'.format(
@@ -240,32 +290,52 @@ def run_job(
     # Reshape to regions
 
     logger.debug('{} reshaping to regions'.format(model))
-    if not agglev.startswith('grid'):
-        ds = weighted_aggregate_grid_to_regions(
-                ds, variable, aggwt, agglev, weights=weights)
+    if gridded:
+        outputs = {level: ds for level in agglevs}
 
-    # Update netCDF metadata
-    logger.debug('{} udpate metadata'.format(model))
-    ds.attrs.update(**metadata)
+    else:
+        outputs = weighted_aggregate_grid_to_regions(
+                ds, variable, aggwt, agglevs, weights=weights, skipna=skipna,
+                regions=regions, partial=partial)
 
-    # Write output
-    logger.debug('attempting to write to file: {}'.format(write_file))
-    if not os.path.isdir(os.path.dirname(write_file)):
-        os.makedirs(os.path.dirname(write_file))
+    logger.debug('attempting to write to files: {}'.format(
+        ', '.join(write_files[level] for level in outputs)))
 
-    ds.to_netcdf(write_file)
+    utils.write_outputs(
+        outputs,
+        write_files,
+        attrs=metadata,
+        skipna=skipna,
+        region_codes=region_codes,
+        table_dir=utils.WEB_REGION_TABLE_DIR)
 
 
 def onfinish():
     print('all done!')
 
 
+def job_inputs(metadata, years, seasons, **kwargs):
+    '''
+    Baseline and pattern files read by a job, staged to node-local disk
+    before it runs
+    '''
+
+    baseline_file = BASELINE_FILE.format(**metadata)
+    pattern_file = BCSD_pattern_files.format(**metadata)
+
+    return (
+        [baseline_file.format(season=season) for season in seasons] +
+        [pattern_file.format(year=year, season=season)
+            for year in years for season in seasons])
+
+
 main = utils.slurm_runner(
     filepath=__file__,
     job_spec=JOB_SPEC,
     run_job=run_job,
     onfinish=onfinish,
-    additional_metadata=ADDITIONAL_METADATA)
+    additional_metadata=ADDITIONAL_METADATA,
+    inputs=job_inputs)
 
 
 if __name__ == '__main__':
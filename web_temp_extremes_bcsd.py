@@ -18,6 +18,8 @@ import utils
 from climate_toolbox import (
     load_bcsd,
     load_baseline,
+    has_bcsd_store,
+    prepare_aggregation,
     weighted_aggregate_grid_to_regions)
 
 FORMAT = '%(asctime)-15s %(message)s'
@@ -168,7 +170,13 @@ def run_job(
         model,
         agglev,
         aggwt,
-        weights=None):
+        weights=None,
+        skipna=False,
+        regions=None,
+        region_codes=False,
+        partial=False,
+        chunks=None,
+        prefetch=1):
 
     logger.debug('Beginning job\nkwargs:\t{}'.format(
         pprint.pformat(metadata, indent=2)))
@@ -178,21 +186,43 @@ def run_job(
         time_horizon='{}-{}'.format(years[0], years[-1])))
 
     read_file = BCSD_orig_files.format(**metadata)
-    write_file = WRITE_PATH.format(**metadata)
+    write_file = utils.output_path(
+        WRITE_PATH.format(**metadata),
+        regions=regions,
+        skipna=(skipna and not agglev.startswith('grid')),
+        partial=(partial and not agglev.startswith('grid')))
     
     # do not duplicate
     if os.path.isfile(write_file):
         return
 
-    # Prepare annual transformed data
-    annual = []
-    for y in years:
+    weights, fill, window = prepare_aggregation(
+        agglev, weights=weights, skipna=skipna, regions=regions)
+
+    def load_year(y):
         fp = read_file.format(year=y)
-        
+
         logger.debug('attempting to load BCSD file: {}'.format(fp))
-        annual.append(
-            load_bcsd(fp, variable, broadcast_dims=('time',))
-                .pipe(transformation))
+
+        if not (fill and has_bcsd_store(fp, variable)):
+            fp = utils.staged(fp)
+
+        return load_bcsd(
+            fp,
+            variable,
+            broadcast_dims=('time',),
+            workers=utils.get_num_workers(),
+            weights=weights,
+            fill=fill,
+            chunks=chunks,
+            window=window,
+            variables=[variable],
+            standardize_lon=agglev.startswith('grid'))
+
+    # Prepare annual transformed data, reading ahead in the background
+    annual = []
+    for ds in utils.prefetch(load_year, years, depth=prefetch):
+        annual.append(ds.pipe(transformation))
 
     # Concatente years to single dataset and average across years
     logger.debug('{} - concatenating annual data'.format(model))
@@ -204,19 +234,21 @@ def run_job(
     logger.debug('{} reshaping to regions'.format(model))
     if not agglev.startswith('grid'):
         ds = weighted_aggregate_grid_to_regions(
-                ds, variable, aggwt, agglev, weights=weights)
-
-    # Update netCDF metadata
-    logger.debug('{} udpate metadata'.format(model))
-    ds.attrs.update(
-        **{k: str(v) for k, v in metadata.items() if k in DS_METADATA_FEILDS})
+                ds, variable, aggwt, agglev, weights=weights, skipna=skipna,
+                regions=regions, partial=partial)
 
-    # Write output
     logger.debug('attempting to write to file: {}'.format(write_file))
-    if not os.path.isdir(os.path.dirname(write_file)):
-        os.makedirs(os.path.dirname(write_file))
 
-    ds.to_netcdf(write_file)
+    utils.write_outputs(
+        {agglev: ds},
+        {agglev: write_file},
+        attrs={
+            k: str(v) for k, v in metadata.items()
+            if k in DS_METADATA_FEILDS},
+        skipna=skipna,
+        region_codes=region_codes,
+        table_dir=utils.WEB_REGION_TABLE_DIR)
+
     logger.debug('done')
 
 
@@ -224,12 +256,28 @@ def onfinish():
     print('all done!')
 
 
+def job_inputs(metadata, years, **kwargs):
+    '''
+    BCSD files read by a job, staged to node-local disk before it runs
+
+    Files that have been preprocessed (see ``preprocess_bcsd.py``) are not
+    staged.
+    '''
+
+    read_file = BCSD_orig_files.format(**metadata)
+
+    return [
+        read_file.format(year=y) for y in years
+        if not has_bcsd_store(read_file.format(year=y), metadata['variable'])]
+
+
 main = utils.slurm_runner(
     filepath=__file__,
     job_spec=JOB_SPEC,
     run_job=run_job,
     onfinish=onfinish,
-    additional_metadata=ADDITIONAL_METADATA)
+    additional_metadata=ADDITIONAL_METADATA,
+    inputs=job_inputs)
 
 
 if __name__ == '__main__':
@@ -18,6 +18,7 @@ import utils
 from climate_toolbox import (
     load_bcsd,
     load_baseline,
+    prepare_aggregation,
     weighted_aggregate_grid_to_regions)
 
 FORMAT = '%(asctime)-15s %(message)s'
@@ -193,7 +194,12 @@ def run_job(
         seasons,
         agglev,
         aggwt,
-        weights=None):
+        weights=None,
+        skipna=False,
+        regions=None,
+        region_codes=False,
+        partial=False,
+        prefetch=1):
 
     logger.debug('Beginning job\nkwargs:\t{}'.format(
         pprint.pformat(metadata, indent=2)))
@@ -204,12 +210,19 @@ def run_job(
 
     baseline_file = BASELINE_FILE.format(**metadata)
     pattern_file = BCSD_pattern_files.format(**metadata)
-    write_file = WRITE_PATH.format(**metadata)
+    write_file = utils.output_path(
+        WRITE_PATH.format(**metadata),
+        regions=regions,
+        skipna=(skipna and not agglev.startswith('grid')),
+        partial=(partial and not agglev.startswith('grid')))
     
     # do not duplicate
     if os.path.isfile(write_file):
         return
 
+    weights, fill, window = prepare_aggregation(
+        agglev, weights=weights, skipna=skipna, regions=regions)
+
     # Get transformed data
     total = None
 
@@ -217,18 +230,42 @@ def run_job(
     for season in seasons:
         basef = baseline_file.format(season=season)
         logger.debug('attempting to load baseline file: {}'.format(basef))
-        seasonal_baselines[season] = load_baseline(basef, variable)
+        seasonal_baselines[season] = load_baseline(
+            utils.staged(basef),
+            variable,
+            weights=weights,
+            fill=fill,
+            window=window,
+            variables=[variable])
 
     season_month_start = {'DJF': 12, 'MAM': 3, 'JJA': 6, 'SON': 9}
 
+    def load_pattern(year_season):
+        year, season = year_season
+
+        pattf = pattern_file.format(year=year, season=season)
+        logger.debug('attempting to load pattern file: {}'.format(pattf))
+        return load_bcsd(
+            utils.staged(pattf),
+            variable,
+            broadcast_dims=('day',),
+            workers=utils.get_num_workers(),
+            weights=weights,
+            fill=fill,
+            window=window,
+            variables=[variable])
+
+    # read the next pattern files in the background while this one computes
+    patterns = utils.prefetch(
+        load_pattern,
+        [(year, season) for year in years for season in seasons],
+        depth=prefetch)
+
     for year in years:
         seasonal = []
 
         for s, season in enumerate(seasons):
-
-            pattf = pattern_file.format(year=year, season=season)
-            logger.debug('attempting to load pattern file: {}'.format(pattf))
-            patt = load_bcsd(pattf, variable, broadcast_dims=('day',))
+            patt = next(patterns)
 
             logger.debug(
                 '{} {} {} - reindexing coords day --> time'.format(
@@ -273,19 +310,21 @@ def run_job(
     logger.debug('{} reshaping to regions'.format(model))
     if not agglev.startswith('grid'):
         ds = weighted_aggregate_grid_to_regions(
-                ds, variable, aggwt, agglev, weights=weights)
-
-    # Update netCDF metadata
-    logger.debug('{} udpate metadata'.format(model))
-    ds.attrs.update(
-        **{k: str(v) for k, v in metadata.items() if k in DS_METADATA_FEILDS})
+                ds, variable, aggwt, agglev, weights=weights, skipna=skipna,
+                regions=regions, partial=partial)
 
-    # Write output
     logger.debug('attempting to write to file: {}'.format(write_file))
-    if not os.path.isdir(os.path.dirname(write_file)):
-        os.makedirs(os.path.dirname(write_file))
 
-    ds.to_netcdf(write_file)
+    utils.write_outputs(
+        {agglev: ds},
+        {agglev: write_file},
+        attrs={
+            k: str(v) for k, v in metadata.items()
+            if k in DS_METADATA_FEILDS},
+        skipna=skipna,
+        region_codes=region_codes,
+        table_dir=utils.WEB_REGION_TABLE_DIR)
+
     logger.debug('done')
 
 
@@ -293,12 +332,28 @@ def onfinish():
     print('all done!')
 
 
+def job_inputs(metadata, years, seasons, **kwargs):
+    '''
+    Baseline and pattern files read by a job, staged to node-local disk
+    before it runs
+    '''
+
+    baseline_file = BASELINE_FILE.format(**metadata)
+    pattern_file = BCSD_pattern_files.format(**metadata)
+
+    return (
+        [baseline_file.format(season=season) for season in seasons] +
+        [pattern_file.format(year=year, season=season)
+            for year in years for season in seasons])
+
+
 main = utils.slurm_runner(
     filepath=__file__,
     job_spec=JOB_SPEC,
     run_job=run_job,
     onfinish=onfinish,
-    additional_metadata=ADDITIONAL_METADATA)
+    additional_metadata=ADDITIONAL_METADATA,
+    inputs=job_inputs)
 
 
 if __name__ == '__main__':